@@ -0,0 +1,126 @@
+"""
+Throughput of the embedding binarization of build_vespa_feed, per patch against vectorized.
+
+Generates synthetic page embeddings in every wire format of the predictor and
+times, per page, the conversion into the hex strings of Vespa's binary field:
+- per_patch: the previous implementation, a torch tensor binarized, bit-packed and
+  hex-encoded one patch at a time (a NumPy array per patch when torch is missing)
+- vectorized: app.utils.embeddings.binary_patch_hexes, one pass over the page
+Both include decoding the predictor format and must produce the same strings.
+
+Run it from the API root:
+
+  python -m app.benchmarks.feed_report --pages 200 --patches 768 [--format binary]
+"""
+
+import argparse
+import base64
+import json
+import time
+
+import numpy as np
+
+from app.utils.embeddings import binary_patch_hexes, decode_embedding, is_binary_embedding
+
+FORMATS = ['json', 'float16', 'bfloat16', 'binary']
+
+
+def encode_page(page, embedding_format):
+  """
+  Encodes a float32 page embedding as the predictor returns it.
+
+  Args:
+      page (np.ndarray): Patch vectors of the page, [patches, dim]
+      embedding_format (str): One of FORMATS
+
+  Returns:
+      Nested lists of floats or an encoded embedding object
+  """
+  if embedding_format == 'json':
+    return page.tolist()
+  if embedding_format == 'float16':
+    data = page.astype('<f2').tobytes()
+  elif embedding_format == 'bfloat16':
+    data = (page.view(np.uint32) >> 16).astype('<u2').tobytes()
+  else:
+    data = np.packbits(page > 0, axis=-1).tobytes()
+  return {'dtype': embedding_format, 'shape': list(page.shape), 'data': base64.b64encode(data).decode('ascii')}
+
+
+def per_patch_hexes(embedding) -> list:
+  """
+  The previous binarization of build_vespa_feed: one NumPy round trip per patch vector.
+
+  Args:
+      embedding: Nested lists of floats or an encoded embedding object
+
+  Returns:
+      list: Hex string of the packed bits of each patch vector
+  """
+  if is_binary_embedding(embedding):
+    return [packed_patch.astype(np.int8).tobytes().hex() for packed_patch in decode_embedding(embedding)]
+  try:
+    import torch
+
+    patches = torch.tensor(decode_embedding(embedding), dtype=torch.float32)
+  except ImportError:
+    patches = decode_embedding(embedding)
+  hexes = []
+  for patch_embedding in patches:
+    patch_array = patch_embedding.numpy() if hasattr(patch_embedding, 'numpy') else patch_embedding
+    binary = np.where(patch_array > 0, 1, 0)
+    hexes.append(np.packbits(binary).astype(np.int8).tobytes().hex())
+  return hexes
+
+
+def pages_per_second(binarize, pages, repeat):
+  """
+  Best throughput of a binarization function over several runs on the same pages.
+
+  Args:
+      binarize (callable): Embedding -> list of hex strings
+      pages (list): Encoded page embeddings
+      repeat (int): Runs, the fastest is kept
+
+  Returns:
+      float: Pages per second
+  """
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for page in pages:
+      binarize(page)
+    best = min(best, time.perf_counter() - start)
+  return len(pages) / best
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare per-patch and vectorized binarization of the Vespa feed')
+  parser.add_argument('--pages', type=int, default=100, help='Synthetic pages per format (default 100)')
+  parser.add_argument('--patches', type=int, default=768, help='Patch vectors per page (default 768)')
+  parser.add_argument('--dim', type=int, default=128, help='Dimension of the patch vectors (default 128)')
+  parser.add_argument('--repeat', type=int, default=3, help='Runs per measure, the fastest is kept (default 3)')
+  parser.add_argument('--format', action='append', choices=FORMATS, help='Embedding format (default all)')
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  results = {'pages': args.pages, 'patches': args.patches, 'dim': args.dim}
+  for embedding_format in args.format or FORMATS:
+    pages = [
+      encode_page(rng.standard_normal((args.patches, args.dim), dtype=np.float32), embedding_format)
+      for _ in range(args.pages)
+    ]
+    if any(per_patch_hexes(page) != binary_patch_hexes(page) for page in pages):
+      raise SystemExit(f'❌ Vectorized binarization differs from the per patch one for {embedding_format}')
+    per_patch = pages_per_second(per_patch_hexes, pages, args.repeat)
+    vectorized = pages_per_second(binary_patch_hexes, pages, args.repeat)
+    results[embedding_format] = {
+      'per_patch_pages_per_second': round(per_patch, 1),
+      'vectorized_pages_per_second': round(vectorized, 1),
+      'speedup': round(vectorized / per_patch, 1),
+    }
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -10,6 +10,18 @@ load_dotenv()
 VERTEX_PROJECT_ID = os.environ['VERTEX_PROJECT_ID']
 VERTEX_LOCATION = os.environ['VERTEX_LOCATION']
 VERTEX_ENDPOINT_ID = os.environ['VERTEX_ENDPOINT_ID']
+# Embedding wire format requested from the predictor: 'json', 'float16', 'bfloat16' or 'binary'
+VERTEX_DOCUMENT_EMBEDDING_FORMAT = os.environ.get('VERTEX_DOCUMENT_EMBEDDING_FORMAT', 'binary')
+VERTEX_QUERY_EMBEDDING_FORMAT = os.environ.get('VERTEX_QUERY_EMBEDDING_FORMAT', 'float16')
+# PDFs up to this size are sent inline to the predictor (base64 in the request) instead of
+# being downloaded back from the bucket. Vertex AI online predictions are limited to 1.5 MB
+# per request and base64 adds a third, beyond it the predictor gets the bucket URL.
+VERTEX_INLINE_PDF_MAX_BYTES = int(os.environ.get('VERTEX_INLINE_PDF_MAX_BYTES', 1_000_000))
+# Documents longer than VERTEX_SHARD_PAGES pages are split into page ranges embedded by
+# concurrent predict calls (spread over the endpoint replicas), at most
+# VERTEX_SHARD_CONCURRENCY at a time. 0 sends every document in a single call.
+VERTEX_SHARD_PAGES = int(os.environ.get('VERTEX_SHARD_PAGES', 16))
+VERTEX_SHARD_CONCURRENCY = int(os.environ.get('VERTEX_SHARD_CONCURRENCY', 4))
 
 # Google Bucket Config
 PDF_GBUCKET_NAME = os.environ['PDF_GBUCKET_NAME']
@@ -29,3 +41,23 @@ VESPA_ENDPOINT = os.environ.get('VESPA_ENDPOINT', None)
 VESPA_CLOUD_SECRET_TOKEN = os.environ['VESPA_CLOUD_TOKEN']
 VESPA_KEY_FILENAME = os.environ['VESPA_KEY_FILENAME']
 VESPA_APP_PACKAGE_NAME = os.environ['VESPA_APP_PACKAGE_NAME']
+# Queries and feeds share one persistent HTTP/2 connection pool, opened at startup and
+# closed at shutdown: at most VESPA_POOL_CONNECTIONS connections, idle ones are kept alive
+# VESPA_POOL_KEEPALIVE_SECONDS (Vespa resets connections idle for more than 30 seconds).
+VESPA_POOL_CONNECTIONS = int(os.environ.get('VESPA_POOL_CONNECTIONS', 4))
+VESPA_POOL_KEEPALIVE_SECONDS = float(os.environ.get('VESPA_POOL_KEEPALIVE_SECONDS', 25))
+# Pages are fed at most VESPA_FEED_CONCURRENCY in flight at a time. A page refused with a
+# retriable status (429, 502, 503, 504) or hit by a network error is retried up to
+# VESPA_FEED_MAX_RETRIES times, waiting VESPA_FEED_BACKOFF_SECONDS doubled at every retry (at most
+# VESPA_FEED_MAX_BACKOFF_SECONDS, with jitter).
+VESPA_FEED_CONCURRENCY = int(os.environ.get('VESPA_FEED_CONCURRENCY', 16))
+VESPA_FEED_MAX_RETRIES = int(os.environ.get('VESPA_FEED_MAX_RETRIES', 5))
+VESPA_FEED_BACKOFF_SECONDS = float(os.environ.get('VESPA_FEED_BACKOFF_SECONDS', 0.5))
+VESPA_FEED_MAX_BACKOFF_SECONDS = float(os.environ.get('VESPA_FEED_MAX_BACKOFF_SECONDS', 10))
+# retrieval-and-rerank ranking: each query token retrieves its VESPA_TARGET_HITS nearest
+# pages (hamming distance over the HNSW index), at most VESPA_MAX_QUERY_TERMS tokens (the
+# number of rqN inputs of the rank profile). Candidates are ranked by binary MaxSim, then
+# the best VESPA_RERANK_COUNT are reranked by float MaxSim.
+VESPA_TARGET_HITS = int(os.environ.get('VESPA_TARGET_HITS', 20))
+VESPA_RERANK_COUNT = int(os.environ.get('VESPA_RERANK_COUNT', 100))
+VESPA_MAX_QUERY_TERMS = int(os.environ.get('VESPA_MAX_QUERY_TERMS', 64))
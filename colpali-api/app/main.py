@@ -3,20 +3,27 @@ import json
 import time
 
 import base64
-import torch
 from contextlib import asynccontextmanager
+from typing import Literal
 
-from fastapi import Body, FastAPI, UploadFile, File, Response, Request
+from fastapi import Body, FastAPI, UploadFile, File, Query, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from app.services.vespa.vespaClient import VespaClient
-from app.services.gcloud.vertexClient import generate_embeddings_from_vertex
-from app.services.gcloud.gbucketClient import upload_pdf_to_gcloud_bucket
+from app.services.gcloud.vertexClient import generate_document_embeddings_sharded, generate_embeddings_from_vertex
+from app.services.gcloud.gbucketClient import gcloud_bucket_public_url, upload_pdf_to_gcloud_bucket
 from app.services.gcloud.llamaClient import generate_response_from_llama
 
-from app.config import PDF_GBUCKET_NAME
+from app.config import (
+  PDF_GBUCKET_NAME,
+  VERTEX_DOCUMENT_EMBEDDING_FORMAT,
+  VERTEX_INLINE_PDF_MAX_BYTES,
+  VERTEX_QUERY_EMBEDDING_FORMAT,
+)
+from app.utils.embeddings import decode_embedding
 from app.utils.logger import setup_logger
+from app.utils.shards import count_pdf_pages
 
 logger = setup_logger()
 
@@ -29,12 +36,16 @@ async def lifespan(app: FastAPI):
   logger.info('Application starting up')
   try:
     vespa_client = VespaClient()
+    # Connection pool shared by every search and feed until shutdown
+    await vespa_client.open_session()
     logger.info('Vespa client initialized successfully')
     yield
   except Exception as e:
     logger.error(f'Error during application startup: {str(e)}')
     yield
   finally:
+    if vespa_client is not None:
+      await vespa_client.close_session()
     logger.info('Application shutting down')
 
 
@@ -103,7 +114,10 @@ app.add_middleware(LoggingMiddleware)
 async def deploy():
   global vespa_client
   try:
+    if vespa_client is not None:
+      await vespa_client.close_session()
     vespa_client = VespaClient()
+    await vespa_client.open_session()
     logger.info('Vespa client initialized.')
     return {'status': 'success', 'message': 'Vespa client initialized.'}
   except Exception as e:
@@ -111,39 +125,89 @@ async def deploy():
     return {'status': 'error', 'message': 'Error initializing Vespa client.'}
 
 
+@app.get('/stats')
+async def stats():
+  """Utilisation of the Vespa connection pool (connections, operations in flight, keep-alive reuse)"""
+  return {'vespa_pool': vespa_client.pool_stats() if vespa_client is not None else None}
+
+
+async def settle_upload(upload, pdf_uploaded_url):
+  """
+  Waits for the bucket upload of a /pdf request that failed or timed out, so its outcome is known.
+
+  Args:
+      upload (asyncio.Future or None): The upload, None if it was not started
+      pdf_uploaded_url (str): Public URL of the uploaded PDF
+
+  Returns:
+      str or None: The error of the upload, None if it succeeded or was not started
+  """
+  if upload is None:
+    return None
+  try:
+    await upload
+  except Exception as e:
+    logger.error(f'Error uploading document: {pdf_uploaded_url}, Error: {str(e)}')
+    return str(e)
+  return None
+
+
 @app.post('/pdf')
 async def process_pdf(file: UploadFile = File(...)):
   bucket_name = PDF_GBUCKET_NAME
   destination_blob_name = file.filename
   logger.info(f'Received file: {file.filename}')
+  pdf_uploaded_url = gcloud_bucket_public_url(bucket_name, destination_blob_name)
+  upload = None
   try:
     contents = await file.read()
     logger.info(f'Read file contents for: {file.filename}')
 
-    pdf_uploaded_url = upload_pdf_to_gcloud_bucket(bucket_name, contents, destination_blob_name)
-
-    logger.info(f'Uploaded file to GCloud bucket: {pdf_uploaded_url}')
+    # Small PDFs are sent inline to the predictor, so the upload runs while the pages are
+    # embedded. Larger ones do not fit in a Vertex request: they are uploaded first, since
+    # the predictor downloads them from the bucket when a shard does not fit inline either.
+    inline = len(contents) <= VERTEX_INLINE_PDF_MAX_BYTES
+    upload = asyncio.get_running_loop().run_in_executor(
+      None, upload_pdf_to_gcloud_bucket, bucket_name, contents, destination_blob_name
+    )
+    if not inline:
+      await upload
+      logger.info(f'Uploaded file to GCloud bucket: {pdf_uploaded_url}')
 
+    # Long documents are split into page shards embedded concurrently by the replicas, each
+    # shard sent inline as a PDF of its own pages when it fits
+    page_count = await asyncio.get_running_loop().run_in_executor(None, count_pdf_pages, contents)
     page_met_info = await asyncio.wait_for(
-      generate_embeddings_from_vertex(
-        mode='document',
+      generate_document_embeddings_sharded(
         pdf_url=pdf_uploaded_url,
-        # cache_response=True, ### Used to cache the response from the model for future testing
-        # use_cache=True, ### Used to use a previously cached response without calling the model
+        page_count=page_count,
+        pdf_data=contents,
+        embedding_format=VERTEX_DOCUMENT_EMBEDDING_FORMAT,
       ),
       timeout=300,
     )
-    logger.info(f'Generated embeddings for document: {pdf_uploaded_url}')
+    logger.info(f'Generated embeddings for document: {pdf_uploaded_url} ({page_count} pages)')
+
+    if inline:
+      # The pages fed to Vespa link to the bucket copy, it must exist before they are searchable
+      await upload
+      logger.info(f'Uploaded file to GCloud bucket: {pdf_uploaded_url}')
 
     vespa_feed = vespa_client.build_vespa_feed(page_met_info)
     logger.info(f'Built Vespa feed for document: {pdf_uploaded_url}')
 
-    await vespa_client.feed_data(vespa_feed)
+    feed_report = await vespa_client.feed_data(vespa_feed)
+    if feed_report['failed']:
+      logger.warning(f'{feed_report["failed_count"]} pages could not be fed to Vespa for document: {pdf_uploaded_url}')
     logger.info(f'Fed data to Vespa for document: {pdf_uploaded_url}')
 
-    return {'success': page_met_info, 'url': pdf_uploaded_url}
+    return {'success': page_met_info, 'url': pdf_uploaded_url, 'feed': feed_report}
   except asyncio.TimeoutError:
     logger.warning(f'Processing timeout for document: {pdf_uploaded_url}')
+    # The document is only reported as processing once its bucket copy exists
+    upload_error = await settle_upload(upload, pdf_uploaded_url)
+    if upload_error is not None:
+      return {'error': f'Upload failed: {upload_error}', 'url': pdf_uploaded_url}
     return {
       'status': 'processing',
       'message': 'Processing is ongoing but requires more time. Check the status later.',
@@ -151,27 +215,43 @@ async def process_pdf(file: UploadFile = File(...)):
     }
   except Exception as e:
     logger.error(f'Error processing document: {pdf_uploaded_url}, Error: {str(e)}')
+    upload_error = await settle_upload(upload, pdf_uploaded_url)
+    if upload_error is not None:
+      return {'error': str(e), 'upload_error': upload_error}
     return {'error': str(e)}
 
 
 @app.post('/search')
-async def search(query: str = Body(...)):
-  logger.info(f'Received search query: {query}')
+async def search(
+  query: str = Body(...),
+  ranking: Literal['default', 'retrieval-and-rerank'] = Query('default'),
+):
+  """
+  Searches the indexed pages with the query text (raw request body).
+  - `ranking=default`: BM25 candidates reranked by MaxSim.
+  - `ranking=retrieval-and-rerank`: nearestNeighbor candidates of the query tokens (hamming
+    distance), ranked by binary MaxSim and reranked by float MaxSim, no text overlap needed.
+  The response carries the Vespa timing of the query to compare the two.
+  """
+  logger.info(f'Received search query: {query} (ranking: {ranking})')
   try:
     query_response = await asyncio.wait_for(
       generate_embeddings_from_vertex(
         mode='query',
         query_text=query,
         use_cache=True,
+        embedding_format=VERTEX_QUERY_EMBEDDING_FORMAT,
       ),
       timeout=300,
     )
     logger.info(f'Generated embeddings for query: {query}')
 
-    query_embeddings = torch.tensor(query_response['embeddings'][0])
+    query_embeddings = decode_embedding(query_response['embeddings'][0])
     logger.info(f'Query embeddings: {query_embeddings}')
 
-    response = await vespa_client.query(query, query_embeddings)
+    vespa_start = time.perf_counter()
+    response = await vespa_client.query(query, query_embeddings, ranking=ranking)
+    vespa_seconds = time.perf_counter() - vespa_start
     logger.info(f'Vespa query response: {response}')
 
     results = []
@@ -192,7 +272,15 @@ async def search(query: str = Body(...)):
 
     llama_response = await generate_response_from_llama(image, query)
 
-    return {'query': query, 'results': results, 'llama_response': llama_response}
+    return {
+      'query': query,
+      'ranking': ranking,
+      # Wall-clock time of the Vespa query seen by the API, and Vespa's own breakdown
+      'vespa_seconds': round(vespa_seconds, 4),
+      'vespa_timing': response.json.get('timing'),
+      'results': results,
+      'llama_response': llama_response,
+    }
   except asyncio.TimeoutError:
     logger.warning(f'Search processing timeout for query: {query}')
     return {
@@ -5,7 +5,7 @@ from fastapi import APIRouter, UploadFile, File
 from app.utils.logger import setup_logger
 from app.services.gcloud.gbucketClient import upload_pdf_to_gcloud_bucket
 from app.services.gcloud.vertexClient import generate_embeddings_from_vertex
-from app.config import PDF_GBUCKET_NAME
+from app.config import PDF_GBUCKET_NAME, VERTEX_DOCUMENT_EMBEDDING_FORMAT
 
 from app.main import vespa_client
 
@@ -31,6 +31,7 @@ async def process_pdf(file: UploadFile = File(...)):
       generate_embeddings_from_vertex(
         mode='document',
         pdf_url=pdf_uploaded_url,
+        embedding_format=VERTEX_DOCUMENT_EMBEDDING_FORMAT,
         # cache_response=True, ### Used to cache the response from the model for future testing
         # use_cache=True, ### Used to use a previously cached response without calling the model
       ),
@@ -16,6 +16,11 @@ def upload_pdf_to_gcloud_bucket(bucket_name: str, file_contents: bytes, destinat
 
   blob.make_public()
 
-  pdf_uploaded_url = f'https://storage.googleapis.com/{bucket_name}/{destination_blob_name}'
+  pdf_uploaded_url = gcloud_bucket_public_url(bucket_name, destination_blob_name)
 
   return pdf_uploaded_url
+
+
+def gcloud_bucket_public_url(bucket_name: str, blob_name: str):
+  """Public URL of a blob, known before the upload so that it can be referenced while uploading."""
+  return f'https://storage.googleapis.com/{bucket_name}/{blob_name}'
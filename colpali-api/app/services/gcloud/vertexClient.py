@@ -11,7 +11,11 @@ from app.config import (
   CACHE_DOC_RESPONSE_FILE_NAME,
   CACHE_QUERY_RESPONSE_FILE_NAME,
   CACHE_DIR_ROOT_PATH,
+  VERTEX_INLINE_PDF_MAX_BYTES,
+  VERTEX_SHARD_CONCURRENCY,
+  VERTEX_SHARD_PAGES,
 )
+from app.utils.shards import merge_document_shards, offset_shard_pages, page_shards, split_pdf
 
 aiplatform.init(
   project=VERTEX_PROJECT_ID,
@@ -20,16 +24,32 @@ aiplatform.init(
 
 
 async def generate_embeddings_from_vertex(
-  mode='document', pdf_url=None, query_text=None, use_cache=False, cache_response=False
+  mode='document',
+  pdf_url=None,
+  query_text=None,
+  use_cache=False,
+  cache_response=False,
+  embedding_format=None,
+  pdf_data=None,
+  page_range=None,
 ):
   """
   Generate embeddings asynchronously using the ColQwen2 model on Vertex.
+
+  `embedding_format` asks the predictor for a compact encoding of the embeddings
+  ('float16', 'bfloat16' or 'binary'), see app.utils.embeddings.decode_embedding.
+
+  `pdf_data` (bytes) sends the PDF inline with the request, the predictor then does
+  not download `pdf_url`, which only names the document (url and title of the pages).
+
+  `page_range` ((first_page_index, last_page_index), 0-based, last exclusive) limits
+  the prediction to these pages of the document.
   """
   if mode not in ['document', 'query']:
     raise ValueError("Mode must be either 'document' or 'query'")
 
-  if mode == 'document' and not pdf_url and not use_cache:
-    raise ValueError('PDF URL is required in document mode')
+  if mode == 'document' and not pdf_url and not pdf_data and not use_cache:
+    raise ValueError('PDF URL or PDF data is required in document mode')
   if mode == 'query' and not query_text and not use_cache:
     raise ValueError('Query text is required in query mode')
 
@@ -61,8 +81,14 @@ async def generate_embeddings_from_vertex(
 
   if mode == 'document':
     instances = [{'pdf_url': pdf_url}]
+    if pdf_data:
+      instances[0]['pdf_base64'] = base64.b64encode(pdf_data).decode('ascii')
+    if page_range:
+      instances[0]['first_page_index'], instances[0]['last_page_index'] = page_range
   else:
     instances = [{'query_text': query_text}]
+  if embedding_format:
+    instances[0]['embedding_format'] = embedding_format
 
   response = await predict_async(endpoint_id, instances)
   pages_meta_info = response.predictions[0]
@@ -80,6 +106,83 @@ async def generate_embeddings_from_vertex(
   return pages_meta_info
 
 
+async def generate_document_embeddings_sharded(
+  pdf_url,
+  page_count,
+  pdf_data=None,
+  embedding_format=None,
+  shard_pages=VERTEX_SHARD_PAGES,
+  concurrency=VERTEX_SHARD_CONCURRENCY,
+  inline_max_bytes=VERTEX_INLINE_PDF_MAX_BYTES,
+):
+  """
+  Generate the embeddings of a document in page shards, one predict call per shard.
+
+  The shards are sent concurrently (at most `concurrency` at a time), so the replicas
+  of the endpoint embed the pages of a long document in parallel instead of one
+  replica embedding all of them. The shard predictions are merged in page order.
+
+  Each shard is split out of the PDF and sent inline as a PDF of its own pages, so a
+  replica neither receives nor downloads the rest of the document. A shard whose PDF
+  is still larger than `inline_max_bytes` is sent as a page range of the whole
+  document instead: inline if the whole PDF fits, else by `pdf_url`, which the
+  predictor downloads in full.
+
+  Args:
+      pdf_url (str): URL of the PDF, it must be uploaded unless the whole PDF fits inline
+      page_count (int): Pages of the document
+      pdf_data (bytes, optional): The PDF, without it every shard is downloaded from pdf_url
+      embedding_format (str, optional): Embedding wire format requested from the predictor
+      shard_pages (int): Pages per shard, 0 sends the document in one call
+      concurrency (int): Shards in flight at the same time
+      inline_max_bytes (int): Largest PDF sent inline with a predict call
+
+  Returns:
+      list: The document prediction, in the format of generate_embeddings_from_vertex
+  """
+  semaphore = asyncio.Semaphore(max(1, concurrency))
+  whole_pdf_data = pdf_data if pdf_data is not None and len(pdf_data) <= inline_max_bytes else None
+
+  async def embed_shard(page_range, shard_data):
+    async with semaphore:
+      if shard_data is not None and len(shard_data) <= inline_max_bytes:
+        prediction = await generate_embeddings_from_vertex(
+          mode='document',
+          pdf_url=pdf_url,
+          pdf_data=shard_data,
+          embedding_format=embedding_format,
+        )
+        return offset_shard_pages(prediction[0], page_range[0])
+      prediction = await generate_embeddings_from_vertex(
+        mode='document',
+        pdf_url=pdf_url,
+        pdf_data=whole_pdf_data,
+        embedding_format=embedding_format,
+        page_range=page_range,
+      )
+      return prediction[0]
+
+  shards = page_shards(page_count, shard_pages)
+  if shards == [None]:
+    # The whole document in one call, shard_data None sends it as a page range of itself
+    shards_data = [None]
+  elif pdf_data is not None:
+    shards_data = await asyncio.get_running_loop().run_in_executor(None, split_pdf, pdf_data, shards)
+  else:
+    shards_data = [None] * len(shards)
+  tasks = [
+    asyncio.ensure_future(embed_shard(page_range, shard_data)) for page_range, shard_data in zip(shards, shards_data)
+  ]
+  try:
+    results = await asyncio.gather(*tasks)
+  except BaseException:
+    # A failed shard fails the document, the shards still waiting for their turn are dropped
+    for task in tasks:
+      task.cancel()
+    raise
+  return [merge_document_shards(results)]
+
+
 def generate_embeddings_from_vertex_noasync(
   mode='document', pdf_url=None, query_text=None, use_cache=False, cache_response=False
 ):
@@ -1,5 +1,9 @@
+from contextlib import asynccontextmanager
 from io import BytesIO
-import torch
+import asyncio
+import random
+import time
+import httpx
 import numpy as np
 import base64
 
@@ -25,11 +29,24 @@ from app.config import (
   VESPA_APP_NAME,
   VESPA_KEY_FILENAME,
   VESPA_CLOUD_SECRET_TOKEN,
+  VESPA_FEED_BACKOFF_SECONDS,
+  VESPA_FEED_CONCURRENCY,
+  VESPA_FEED_MAX_BACKOFF_SECONDS,
+  VESPA_FEED_MAX_RETRIES,
+  VESPA_MAX_QUERY_TERMS,
+  VESPA_POOL_CONNECTIONS,
+  VESPA_POOL_KEEPALIVE_SECONDS,
+  VESPA_RERANK_COUNT,
+  VESPA_TARGET_HITS,
 )
+from app.utils.embeddings import binary_patch_hexes
 from app.utils.logger import setup_logger
 
 logger = setup_logger()
 
+# Statuses of a document operation that are worth retrying: throttled or temporarily unavailable
+RETRIABLE_FEED_STATUSES = {429, 502, 503, 504}
+
 
 class VespaClient:
   """
@@ -43,6 +60,9 @@ class VespaClient:
 
   The class supports both connecting to an existing app and creating
   a new Vespa Cloud application.
+
+  Queries and feeds share one persistent HTTP/2 session (a sized, keep-alive connection
+  pool), opened with open_session when the API starts and closed with close_session.
   """
 
   def __init__(self) -> Vespa:
@@ -52,6 +72,8 @@ class VespaClient:
     """
     self.endpoint = VESPA_ENDPOINT
     self.app = None
+    self.session = None
+    self.pool_counters = {'requests': 0, 'connections_opened': 0, 'in_flight': 0, 'peak_in_flight': 0}
 
     if self.endpoint:
       logger.info('Using an existing Vespa application...')
@@ -71,7 +93,7 @@ class VespaClient:
     This method:
     1. Creates the schema for PDF documents
     2. Configures fields for text, images, and embeddings
-    3. Sets up the ranking profile using BM25 and MaxSim
+    3. Sets up the ranking profiles: BM25 then MaxSim, and nearestNeighbor retrieval then MaxSim
     4. Configures HNSW for approximate nearest neighbor search
     5. Deploys the application on Vespa Cloud
 
@@ -99,6 +121,101 @@ class VespaClient:
 
     return self.app
 
+  ### Connection pool
+  async def open_session(self):
+    """
+    Opens the persistent session shared by queries and feeds, if it is not open yet.
+
+    Returns:
+        VespaAsync: The open session
+    """
+    if self.session is None:
+      if not self.app:
+        raise RuntimeError('Vespa app not initialized.')
+      limits = httpx.Limits(
+        max_connections=VESPA_POOL_CONNECTIONS,
+        max_keepalive_connections=VESPA_POOL_CONNECTIONS,
+        keepalive_expiry=VESPA_POOL_KEEPALIVE_SECONDS,
+      )
+      session = self.app.asyncio(
+        connections=VESPA_POOL_CONNECTIONS,
+        timeout=180,
+        limits=limits,
+        event_hooks={'request': [self._on_pool_request]},
+      )
+      # Entering the session only creates its client (it never suspends), so concurrent
+      # callers cannot open a second one before it is stored
+      await session.__aenter__()
+      self.session = session
+      logger.info(f'Opened Vespa connection pool: {VESPA_POOL_CONNECTIONS} connections')
+    return self.session
+
+  async def close_session(self):
+    """
+    Closes the persistent session and its connections.
+    """
+    session, self.session = self.session, None
+    if session is not None:
+      await session.__aexit__(None, None, None)
+      logger.info('Closed Vespa connection pool')
+
+  @asynccontextmanager
+  async def pooled_session(self):
+    """
+    Lends the persistent session for one operation (a query or a fed page), counted in flight meanwhile.
+    """
+    session = await self.open_session()
+    counters = self.pool_counters
+    counters['in_flight'] += 1
+    counters['peak_in_flight'] = max(counters['peak_in_flight'], counters['in_flight'])
+    try:
+      yield session
+    finally:
+      counters['in_flight'] -= 1
+
+  async def _on_pool_request(self, request):
+    """
+    Counts the requests sent on the pool and traces the connections they open.
+    """
+    self.pool_counters['requests'] += 1
+    request.extensions['trace'] = self._trace_pool_request
+
+  async def _trace_pool_request(self, event_name, info):
+    """
+    Counts new connections: a request that does not open one reuses a kept-alive connection.
+    """
+    if event_name == 'connection.connect_tcp.complete':
+      self.pool_counters['connections_opened'] += 1
+
+  def pool_stats(self) -> dict:
+    """
+    Utilisation of the connection pool.
+
+    Returns:
+        dict: Pool size, open and busy connections, operations in flight (and their peak, HTTP/2
+        multiplexes them over the connections), requests sent, connections opened and share of
+        requests served by a kept-alive connection
+    """
+    counters = self.pool_counters
+    connections = []
+    if self.session is not None and self.session.httpx_client is not None:
+      # httpx does not expose its pool, the connections are read from the transport
+      pool = getattr(getattr(self.session.httpx_client, '_transport', None), '_pool', None)
+      connections = list(getattr(pool, 'connections', []))
+    return {
+      'open': self.session is not None,
+      'max_connections': VESPA_POOL_CONNECTIONS,
+      'open_connections': len(connections),
+      'busy_connections': sum(1 for connection in connections if not connection.is_idle()),
+      'in_flight': counters['in_flight'],
+      'peak_in_flight': counters['peak_in_flight'],
+      'requests': counters['requests'],
+      'connections_opened': counters['connections_opened'],
+      'keepalive_reuse_rate': round(1 - counters['connections_opened'] / counters['requests'], 3)
+      if counters['requests']
+      else None,
+    }
+
   ### Utils
   def get_application_package(self, application_package_name: str) -> ApplicationPackage:
     """
@@ -171,24 +288,81 @@ class VespaClient:
     )
     colpali_schema.add_rank_profile(colpali_profile)
 
+    # Candidates come from the nearestNeighbor operators of the query (one rqN input per query
+    # token, hamming distance over the HNSW index) instead of BM25 text overlap. They are
+    # ranked by MaxSim over the binary vectors, then the best ones by MaxSim with the float query.
+    retrieval_inputs = [(f'query(rq{i})', 'tensor<int8>(v[16])') for i in range(VESPA_MAX_QUERY_TERMS)]
+    retrieval_inputs += [
+      ('query(qt)', 'tensor<float>(querytoken{}, v[128])'),
+      ('query(qtb)', 'tensor<int8>(querytoken{}, v[16])'),
+    ]
+    colpali_retrieval_profile = RankProfile(
+      name='retrieval-and-rerank',
+      inputs=retrieval_inputs,
+      functions=[
+        Function(
+          name='max_sim',
+          expression="""
+                        sum(
+                            reduce(
+                                sum(
+                                    query(qt) * unpack_bits(attribute(embedding)) , v
+                                ),
+                                max, patch
+                            ),
+                            querytoken
+                        )
+                    """,
+        ),
+        Function(
+          name='max_sim_binary',
+          expression="""
+                        sum(
+                            reduce(
+                                1 / (1 + sum(
+                                    hamming(query(qtb), attribute(embedding)) , v
+                                )),
+                                max, patch
+                            ),
+                            querytoken
+                        )
+                    """,
+        ),
+      ],
+      first_phase=FirstPhaseRanking(expression='max_sim_binary'),
+      second_phase=SecondPhaseRanking(expression='max_sim', rerank_count=VESPA_RERANK_COUNT),
+    )
+    colpali_schema.add_rank_profile(colpali_retrieval_profile)
+
     app_package = ApplicationPackage(name=application_package_name, schema=[colpali_schema])
 
     return app_package
 
   ### Queries and data feeding methods ###
-  async def feed_data(self, vespa_feed, schema='pdf_page'):
+  async def feed_data(self, vespa_feed, schema='pdf_page', concurrency=VESPA_FEED_CONCURRENCY):
     """
     Uploads data to Vespa Cloud.
 
+    Documents are sent concurrently over the persistent HTTP/2 session, at most
+    `concurrency` in flight at a time. A document refused with a retriable
+    status (429, 502, 503, 504) or hit by a network error is retried with exponential
+    backoff; the others are reported as failed instead of being dropped silently.
+
     Args:
         vespa_feed (list): List of documents to upload
         schema (str): Name of the schema to use
+        concurrency (int): Documents in flight at the same time
 
     Each document must contain:
     - id: Unique identifier
     - embedding: Binary feature vectors
     - text: Document text
     - image: Image in base64 format
+
+    Returns:
+        dict: Feed report with the `succeeded` ids, the `failed` ids (with their last
+        error), the `retried` ids (with their number of retries), the counts and the
+        documents per second
     """
     if not self.app:
       raise RuntimeError('Vespa app not initialized.')
@@ -196,44 +370,114 @@ class VespaClient:
     logger.info(f'Starting to feed data to Vespa schema: {schema}')
     logger.info(f'Number of documents to feed: {len(vespa_feed)}')
 
-    async with self.app.asyncio(connections=1, timeout=180) as session:
-      for page in vespa_feed:
-        try:
-          # Verifica e sanitizza i dati prima dell'invio
-          clean_page = {
-            'id': str(page['id']),
-            'url': str(page.get('url', '')),
-            'title': str(page.get('title', '')),
-            'page_number': int(page.get('page_number', 0)),
-            'image': str(page.get('image', '')),
-            'text': str(page.get('text', '')),
-            'embedding': page.get('embedding', []),
-          }
-
-          logger.info(f"Feeding document ID: {clean_page['id']}")
-          response = await session.feed_data_point(schema=schema, data_id=clean_page['id'], fields=clean_page)
-          if response.is_successful():
-            logger.info(f"Successfully fed document ID: {page['id']}")
-          else:
-            logger.error(f"Error in feed for document ID: {page['id']}, Response: {response.json()}")
-        except Exception as e:
-          logger.error(f"Exception occurred while feeding document ID: {page['id']}, Error: {str(e)}")
-
-    logger.info('Completed feeding data to Vespa')
-
-  async def query(self, query_text, query_embeddings, hits=3, ranking='default'):
+    report = {'succeeded': [], 'failed': {}, 'retried': {}}
+    start = time.perf_counter()
+    pages = iter(vespa_feed)
+
+    async def feed_worker():
+      # Workers share the iterator: a worker takes the next page once its previous one is done
+      for page in pages:
+        await self._feed_page(schema, page, report)
+
+    await asyncio.gather(*[feed_worker() for _ in range(max(1, min(concurrency, len(vespa_feed))))])
+
+    seconds = time.perf_counter() - start
+    report.update(
+      {
+        'documents': len(vespa_feed),
+        'succeeded_count': len(report['succeeded']),
+        'failed_count': len(report['failed']),
+        'retried_count': len(report['retried']),
+        'seconds': round(seconds, 3),
+        'documents_per_second': round(len(report['succeeded']) / max(seconds, 1e-6), 1),
+      }
+    )
+    logger.info(
+      f'Completed feeding data to Vespa: {report["succeeded_count"]} succeeded, {report["failed_count"]} failed, '
+      f'{report["retried_count"]} retried, {report["documents_per_second"]} documents/s'
+    )
+    return report
+
+  async def _feed_page(self, schema, page, report):
+    """
+    Feeds one document, retrying retriable failures with exponential backoff and jitter.
+
+    Args:
+        schema (str): Name of the schema to use
+        page (dict): Document to upload
+        report (dict): Feed report updated with the outcome of the document
+    """
+    data_id = str(page.get('id'))
+    try:
+      # Verifica e sanitizza i dati prima dell'invio
+      clean_page = {
+        'id': str(page['id']),
+        'url': str(page.get('url', '')),
+        'title': str(page.get('title', '')),
+        'page_number': int(page.get('page_number', 0)),
+        'image': str(page.get('image', '')),
+        'text': str(page.get('text', '')),
+        'embedding': page.get('embedding', []),
+      }
+    except (KeyError, TypeError, ValueError) as e:
+      logger.error(f'Invalid document ID: {data_id}, Error: {str(e)}')
+      report['failed'][data_id] = f'Invalid document: {str(e)}'
+      return
+
+    # Posted on the HTTP/2 client of the session, so that retries are handled (and counted) here
+    end_point = self.app.end_point + self.app.get_document_v1_path(id=data_id, schema=schema)
+    for attempt in range(VESPA_FEED_MAX_RETRIES + 1):
+      retry_after = None
+      try:
+        async with self.pooled_session() as session:
+          response = await session.httpx_client.post(end_point, json={'fields': clean_page})
+        if response.status_code == 200:
+          logger.debug(f'Successfully fed document ID: {data_id}')
+          report['succeeded'].append(data_id)
+          return
+        error = f'Status code {response.status_code}: {response.text[:200]}'
+        retriable = response.status_code in RETRIABLE_FEED_STATUSES
+        retry_after = response.headers.get('Retry-After')
+      except httpx.TransportError as e:
+        error = f'{type(e).__name__}: {str(e)}'
+        retriable = True
+
+      if not retriable or attempt == VESPA_FEED_MAX_RETRIES:
+        break
+      report['retried'][data_id] = attempt + 1
+      delay = min(VESPA_FEED_MAX_BACKOFF_SECONDS, VESPA_FEED_BACKOFF_SECONDS * 2**attempt)
+      delay *= random.uniform(0.5, 1)
+      if retry_after and retry_after.isdigit():
+        delay = max(delay, min(VESPA_FEED_MAX_BACKOFF_SECONDS, float(retry_after)))
+      logger.warning(f'Retrying document ID: {data_id} in {delay:.2f}s (retry {attempt + 1}), Error: {error}')
+      await asyncio.sleep(delay)
+
+    logger.error(f'Error in feed for document ID: {data_id}, Error: {error}')
+    report['failed'][data_id] = error
+
+  async def query(
+    self,
+    query_text,
+    query_embeddings,
+    hits=3,
+    ranking='default',
+    target_hits=VESPA_TARGET_HITS,
+    rerank_count=VESPA_RERANK_COUNT,
+  ):
     """
     Executes a query on Vespa Cloud.
 
     Supports two ranking modes:
     1. "default": Uses BM25 + MaxSim for ranking
-    2. "retrieval-and-rerank": Uses nearestNeighbor with Hamming distance
+    2. "retrieval-and-rerank": Uses nearestNeighbor with Hamming distance, then MaxSim
 
     Args:
         query_text (str): Text of the query
         query_embeddings (tensor): Embedding of the query from the ColQwen2 model
         hits (int): Number of results to return
         ranking (str): Ranking strategy to use
+        target_hits (int): Candidates retrieved per query token (retrieval-and-rerank)
+        rerank_count (int): Candidates reranked by float MaxSim (retrieval-and-rerank)
 
     Returns:
         VespaQueryResponse: Query results with scoring
@@ -244,7 +488,7 @@ class VespaClient:
     logger.info(f'Executing query: {query_text}')
     # logger.info(f"Query embeddings: {query_embeddings}")
 
-    async with self.app.asyncio(connections=1, timeout=120) as session:
+    async with self.pooled_session() as session:
       if ranking == 'default':
         # Use ranking based on BM25 + MaxSim
         float_query_embedding = {k: v.tolist() for k, v in enumerate(query_embeddings)}
@@ -258,27 +502,23 @@ class VespaClient:
           body={'input.query(qt)': float_query_embedding, 'presentation.timing': True},
         )
       else:
-        # Use ranking based on nearestNeighbor (Work in progress!)
-        target_hits_per_query_tensor = 20
+        # Use ranking based on nearestNeighbor, independent of the text of the pages
         float_query_embedding = {k: v.tolist() for k, v in enumerate(query_embeddings)}
-        binary_query_embeddings = dict()
-        for k, v in float_query_embedding.items():
-          binary_query_embeddings[k] = np.packbits(np.where(np.array(v) > 0, 1, 0)).astype(np.int8).tolist()
+        packed_query_embeddings = np.packbits(np.asarray(query_embeddings, dtype=np.float32) > 0, axis=-1)
+        binary_query_embeddings = {k: v.tolist() for k, v in enumerate(packed_query_embeddings.astype(np.int8))}
 
         query_tensors = {
           'input.query(qtb)': binary_query_embeddings,
           'input.query(qt)': float_query_embedding,
         }
 
-        # Add tensors for nearestNeighbor
-        for i in range(len(binary_query_embeddings)):
+        # Add tensors for nearestNeighbor, one per query token up to the inputs of the rank profile
+        nn_terms = min(len(binary_query_embeddings), VESPA_MAX_QUERY_TERMS)
+        for i in range(nn_terms):
           query_tensors[f'input.query(rq{i})'] = binary_query_embeddings[i]
 
         # Construct the nearestNeighbor query
-        nn = [
-          f'({{targetHits:{target_hits_per_query_tensor}}}nearestNeighbor(embedding,rq{i}))'
-          for i in range(len(binary_query_embeddings))
-        ]
+        nn = [f'({{targetHits:{target_hits}}}nearestNeighbor(embedding,rq{i}))' for i in range(nn_terms)]
         nn = ' OR '.join(nn)
 
         response = await session.query(
@@ -286,7 +526,7 @@ class VespaClient:
           ranking='retrieval-and-rerank',
           timeout=120,
           hits=hits,
-          body={**query_tensors, 'presentation.timing': True},
+          body={**query_tensors, 'ranking.rerankCount': rerank_count, 'presentation.timing': True},
         )
       logger.info(f'Query response status code: {response.status_code}')
       # logger.info(f"Query response content: {response.content}")
@@ -302,7 +542,7 @@ class VespaClient:
     Prepares data for insertion into Vespa.
 
     Key functionalities:
-    1. Converts embeddings into binary format
+    1. Converts embeddings into binary format (one vectorized pass per page)
     2. Resizes and encodes images in base64
     3. Organizes metadata into Vespa-compatible format
 
@@ -313,23 +553,6 @@ class VespaClient:
         list: A list of documents formatted for Vespa.
     """
 
-    def process_embedding(patch_embedding):
-      """
-      Converts an embedding into compressed binary format.
-
-      Args:
-          patch_embedding: Embedding to process
-
-      Returns:
-          str: Hexadecimal string of the binary embedding
-      """
-      # Convert the tensor to numpy and ensure it's a float
-      patch_array = patch_embedding.numpy()
-      # Perform binarization
-      binary = np.where(patch_array > 0, 1, 0)
-      # Convert to bit-packed format
-      return np.packbits(binary).astype(np.int8).tobytes().hex()
-
     def get_base64_image(image):
       """
       Converts an image to base64 format.
@@ -371,19 +594,17 @@ class VespaClient:
     for pdf in pdfs_data:
       url = pdf['url']
       title = pdf['title']
-      for page_number, (page_text, embedding_list, image) in enumerate(
-        zip(pdf['texts'], pdf['embeddings'], pdf['images'])
+      # The predictor leaves blank pages out and gives the index of every page it returns
+      page_numbers = pdf.get('page_indexes') or range(len(pdf['texts']))
+      for page_number, page_text, embedding_list, image in zip(
+        page_numbers, pdf['texts'], pdf['embeddings'], pdf['images']
       ):
-        # Step 1: Deserializzare l'embedding da lista a tensore
-        embedding_tensor = torch.tensor(embedding_list, dtype=torch.float32)
-
-        # Step 2: Convertire ogni embedding in formato binario
-        embedding_dict = {}
-        for idx, patch_embedding in enumerate(embedding_tensor):
-          binary_vector = process_embedding(patch_embedding)
-          embedding_dict[idx] = binary_vector
+        # Steps 1-2: Binarize the patch vectors of the page (as they are when the predictor
+        # already sent them binarized) and hex-encode the packed bits of each patch
+        embedding_dict = dict(enumerate(binary_patch_hexes(embedding_list)))
 
         # Step 3: Convertire l'immagine in base64
+        # (the predictor already returns base64 thumbnails rendered at the stored height, kept as they are)
         base_64_image = get_base64_image(resize_image(image, 640))
 
         # Step 4: Creare il documento per Vespa
@@ -0,0 +1,70 @@
+import base64
+
+import numpy as np
+
+
+def decode_embedding(embedding) -> np.ndarray:
+  """
+  Decodes one multi-vector embedding returned by the Vertex predictor.
+
+  The predictor returns plain nested lists by default, or a compact
+  `{'dtype', 'shape', 'data'}` object when an `embedding_format` was requested:
+  - float16: wrapped without copying the decoded bytes
+  - bfloat16: widened to float32 (NumPy has no bfloat16)
+  - binary: packed sign bits, uint8 array of shape [vectors, dim / 8]
+
+  Args:
+      embedding: Nested lists of floats or an encoded embedding object
+
+  Returns:
+      np.ndarray: The decoded embedding
+  """
+  if not isinstance(embedding, dict):
+    return np.asarray(embedding, dtype=np.float32)
+
+  data = base64.b64decode(embedding['data'])
+  shape = embedding['shape']
+  dtype = embedding['dtype']
+
+  if dtype == 'float16':
+    return np.frombuffer(data, dtype='<f2').reshape(shape)
+  if dtype == 'bfloat16':
+    bits = np.frombuffer(data, dtype='<u2').reshape(shape)
+    return (bits.astype(np.uint32) << 16).view(np.float32)
+  if dtype == 'binary':
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape[0], -1)
+  raise ValueError(f'Unknown embedding dtype: {dtype}')
+
+
+def is_binary_embedding(embedding) -> bool:
+  """
+  Tells whether an embedding returned by the predictor is already binarized.
+  """
+  return isinstance(embedding, dict) and embedding.get('dtype') == 'binary'
+
+
+def binary_patch_hexes(embedding) -> list:
+  """
+  Binarizes an embedding returned by the predictor into the hex strings of Vespa's binary
+  `embedding` field, one per patch vector.
+
+  The whole page is handled in one pass: the sign bits (`value > 0`) of every patch are
+  packed at once (or taken as they are when the predictor already sent them packed) and
+  the packed rows are hex-encoded in a single call, then sliced per patch.
+
+  Args:
+      embedding: Nested lists of floats or an encoded embedding object
+
+  Returns:
+      list: Hex string of the packed bits of each patch vector, in patch order
+  """
+  if is_binary_embedding(embedding):
+    packed = decode_embedding(embedding)
+  else:
+    # float16 comparisons are emulated by NumPy, widening first is several times faster
+    packed = np.packbits(decode_embedding(embedding).astype(np.float32, copy=False) > 0, axis=-1)
+  if packed.size == 0:
+    return []
+  row_chars = 2 * packed.shape[-1]
+  hexes = np.ascontiguousarray(packed).tobytes().hex()
+  return [hexes[start : start + row_chars] for start in range(0, len(hexes), row_chars)]
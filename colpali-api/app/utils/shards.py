@@ -0,0 +1,114 @@
+from io import BytesIO
+
+from pypdf import PdfReader, PdfWriter
+
+
+def count_pdf_pages(pdf_data) -> int:
+  """
+  Counts the pages of a PDF without rendering it (only the page tree is read).
+
+  Args:
+      pdf_data (bytes): The PDF file
+
+  Returns:
+      int: Number of pages
+  """
+  return len(PdfReader(BytesIO(pdf_data)).pages)
+
+
+def page_shards(page_count, shard_pages) -> list:
+  """
+  Splits the pages of a document into consecutive shards, each embedded by its own predict call.
+
+  Args:
+      page_count (int): Pages of the document
+      shard_pages (int): Pages per shard, 0 keeps the whole document in one shard
+
+  Returns:
+      list: (first_page_index, last_page_index) tuples, 0-based with the last index exclusive,
+      or [None] when the document is not split
+  """
+  if shard_pages <= 0 or page_count <= shard_pages:
+    return [None]
+  return [(first, min(first + shard_pages, page_count)) for first in range(0, page_count, shard_pages)]
+
+
+def split_pdf(pdf_data, page_ranges) -> list:
+  """
+  Writes the pages of each page range as a PDF of its own, so that a shard carries its pages only.
+
+  Resources shared by several pages (fonts, images) are copied into every part that uses them.
+
+  Args:
+      pdf_data (bytes): The PDF file
+      page_ranges (list): (first_page_index, last_page_index) tuples, 0-based with the last index exclusive
+
+  Returns:
+      list: The PDF (bytes) of each page range, in the order of page_ranges
+  """
+  reader = PdfReader(BytesIO(pdf_data))
+  parts = []
+  for page_range in page_ranges:
+    writer = PdfWriter()
+    writer.append(reader, pages=page_range)
+    part = BytesIO()
+    writer.write(part)
+    parts.append(part.getvalue())
+  return parts
+
+
+def offset_shard_pages(shard, first_page_index) -> dict:
+  """
+  Moves the pages of a shard predicted from a split PDF back to their place in the whole document.
+
+  Args:
+      shard (dict): Document prediction of the PDF of the shard, its pages numbered from 0
+      first_page_index (int): Index of the first page of the shard in the whole document
+
+  Returns:
+      dict: The same prediction, its page indexes in the whole document
+  """
+  page_indexes = shard.get('page_indexes') or range(len(shard['texts']))
+  shard['page_indexes'] = [first_page_index + page_index for page_index in page_indexes]
+  for key in ('first_page_index', 'last_page_index'):
+    if shard.get(key) is not None:
+      shard[key] += first_page_index
+  return shard
+
+
+def merge_document_shards(shards) -> dict:
+  """
+  Merges the predictions of the shards of one document back into a single document prediction.
+
+  Pages are concatenated in page order (shards come in the order of their page ranges)
+  and the skipped and reused page counters are added up. The pipeline stats of the
+  shards are kept side by side, each shard ran on its own replica.
+
+  Args:
+      shards (list): Document predictions (dict) of the shards, in page order
+
+  Returns:
+      dict: The document prediction, in the format of a single predict call
+  """
+  if len(shards) == 1:
+    return shards[0]
+  merged = {
+    'url': shards[0]['url'],
+    'title': shards[0]['title'],
+    'page_indexes': [],
+    'images': [],
+    'texts': [],
+    'embeddings': [],
+    'pages_skipped': 0,
+    'pages_reused': 0,
+    'stats': [],
+  }
+  for shard in shards:
+    merged['page_indexes'].extend(shard['page_indexes'])
+    merged['images'].extend(shard['images'])
+    merged['texts'].extend(shard['texts'])
+    merged['embeddings'].extend(shard['embeddings'])
+    merged['pages_skipped'] += shard.get('pages_skipped', 0)
+    merged['pages_reused'] += shard.get('pages_reused', 0)
+    merged['stats'].append(shard.get('stats'))
+  return merged
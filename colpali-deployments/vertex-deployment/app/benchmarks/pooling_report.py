@@ -0,0 +1,120 @@
+"""
+Storage saving and MaxSim score drift of hierarchical token pooling.
+
+Embeds the pages of a sample corpus and a set of queries once, then pools the
+page embeddings at each pool factor and compares them with the unpooled ones:
+- vectors and binary storage per page (what the Vespa feed stores)
+- relative drift of the MaxSim score of every (query, page) pair, both on the
+  float vectors and on the sign bits scored by Vespa (query . unpack_bits(page))
+- share of queries whose best page in the corpus is unchanged
+
+Run it in the predictor image, from the deployment root:
+
+  python -m app.benchmarks.pooling_report --pdf a.pdf --pdf b.pdf \\
+    --query 'quarterly revenue' --query 'board members' --pool-factor 2 --pool-factor 3
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import torch
+
+from app.utils.pipeline import PipelineStats
+from app.utils.pooling import pool_embedding
+from app.utils.predictor import PAGE_WINDOW_SIZE, Predictor
+
+
+# Embed every page of a PDF file, without pooling
+# Input: predictor (Predictor), pdf_path (str)
+# Output: List[torch.Tensor] (one embedding per page)
+def embed_pdf(predictor, pdf_path):
+  stats = PipelineStats()
+  page_count = predictor.get_pdf_page_count(pdf_path)
+  embeddings = []
+  for first_page_index in range(0, page_count, PAGE_WINDOW_SIZE):
+    last_page_index = min(first_page_index + PAGE_WINDOW_SIZE, page_count)
+    _, _, model_images, page_keys, _ = predictor.rasterize_window(pdf_path, first_page_index, last_page_index, stats)
+    embeddings.extend(predictor.embed_window(model_images, page_keys, stats))
+  return embeddings
+
+
+# MaxSim score of one query against every page
+# Input: query (np.ndarray [tokens, dim]), pages (List[np.ndarray [vectors, dim]])
+# Output: np.ndarray [pages]
+def max_sim(query, pages):
+  return np.array([(query @ page.T).max(axis=1).sum() for page in pages])
+
+
+# Compare pooled pages with the unpooled ones over all queries
+# Input: queries (List[np.ndarray]), pages (List[np.ndarray]), pooled_pages (List[np.ndarray])
+# Output: Dict[str, Any]
+def compare_scores(queries, pages, pooled_pages):
+  drifts = []
+  same_best_page = 0
+  for query in queries:
+    scores = max_sim(query, pages)
+    pooled_scores = max_sim(query, pooled_pages)
+    drifts.append(np.abs(pooled_scores - scores) / np.maximum(np.abs(scores), 1e-6))
+    same_best_page += int(np.argmax(scores) == np.argmax(pooled_scores))
+  drifts = np.concatenate(drifts)
+  return {
+    'mean_relative_drift': round(float(drifts.mean()), 4),
+    'max_relative_drift': round(float(drifts.max()), 4),
+    'same_best_page': round(same_best_page / len(queries), 3),
+  }
+
+
+# Pool the pages at each factor and measure storage and scores against the unpooled pages
+# Input: pages (List[np.ndarray]), queries (List[np.ndarray]), pool_factors (List[int])
+# Output: Dict[str, Any] (report, one entry per pool factor)
+def report(pages, queries, pool_factors):
+  dim = pages[0].shape[1]
+  binary_pages = [(page > 0).astype(np.float32) for page in pages]
+  base_vectors = np.mean([len(page) for page in pages])
+  results = {
+    'pages': len(pages),
+    'queries': len(queries),
+    'unpooled': {
+      'vectors_per_page': round(float(base_vectors), 1),
+      'binary_bytes_per_page': round(float(base_vectors * dim / 8), 1),
+    },
+  }
+  for pool_factor in pool_factors:
+    start = time.perf_counter()
+    pooled_pages = [pool_embedding(torch.from_numpy(page), pool_factor).numpy() for page in pages]
+    pool_seconds = time.perf_counter() - start
+    pooled_vectors = np.mean([len(page) for page in pooled_pages])
+    results[f'pool_factor_{pool_factor}'] = {
+      'vectors_per_page': round(float(pooled_vectors), 1),
+      'binary_bytes_per_page': round(float(pooled_vectors * dim / 8), 1),
+      'storage_saving': round(float(base_vectors / pooled_vectors), 2),
+      'pool_ms_per_page': round(pool_seconds / len(pages) * 1000, 2),
+      'float_maxsim': compare_scores(queries, pages, pooled_pages),
+      'binary_maxsim': compare_scores(queries, binary_pages, [(page > 0).astype(np.float32) for page in pooled_pages]),
+    }
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Report the effect of hierarchical token pooling on a sample corpus')
+  parser.add_argument('--pdf', action='append', required=True, help='Sample PDF file (repeatable)')
+  parser.add_argument('--query', action='append', required=True, help='Sample query (repeatable)')
+  parser.add_argument('--pool-factor', action='append', type=int, help='Pool factor to evaluate (default 2 and 3)')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+
+  predictor = Predictor()
+  predictor.setup()
+
+  # Unpooled baseline without the zero vectors of batch padding, as the pooled pages
+  embeddings = [embedding for path in args.pdf for embedding in embed_pdf(predictor, path)]
+  pages = [pool_embedding(embedding, 1).float().numpy() for embedding in embeddings]
+  queries = [embedding.float().numpy() for embedding in predictor.embed_queries(args.query)]
+  print(json.dumps(report(pages, queries, args.pool_factor or [2, 3]), indent=2))
+
+
+if __name__ == '__main__':
+  main()
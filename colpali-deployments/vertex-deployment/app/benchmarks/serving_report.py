@@ -0,0 +1,223 @@
+"""
+Resident memory and throughput of preload-and-fork serving against independent workers.
+
+Starts the predictor server on a local port in each serving mode, with the same
+number of workers and the same thread budget per worker:
+- preload: `python -m app.serve`, the model is loaded once and the workers are forked
+- independent: `uvicorn --workers N`, every worker loads its own copy of the model
+then, once every worker answers, measures the memory of the server's process tree
+and sends predict requests from concurrent clients for a fixed duration.
+
+Memory is the sum of the PSS of the processes (shared pages are divided between the
+processes sharing them), which is what the workers actually cost; the sum of the RSS
+counts the shared weights once per worker and is reported alongside. The query cache
+and the page embedding store are disabled so that every request reaches the model.
+
+Run it in the predictor image, from the deployment root:
+
+  python -m app.benchmarks.serving_report --workers 4 --duration 60 [--pdf sample.pdf]
+"""
+
+import argparse
+import base64
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from app.utils.cpu_profile import container_cpu_count
+
+
+# Pids of a process and of all its descendants
+# Input: pid (int)
+# Output: List[int]
+def process_tree(pid):
+  pids = [pid]
+  for task in os.listdir(f'/proc/{pid}/task'):
+    try:
+      with open(f'/proc/{pid}/task/{task}/children') as f:
+        children = [int(child) for child in f.read().split()]
+    except OSError:
+      continue
+    for child in children:
+      pids.extend(process_tree(child))
+  return pids
+
+
+# Sum the proportional and resident set sizes of some processes
+# Input: pids (List[int])
+# Output: Dict[str, float] (pss_mb, rss_mb, processes)
+def memory_of(pids):
+  totals = {'Pss': 0, 'Rss': 0}
+  processes = 0
+  for pid in pids:
+    try:
+      with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+          field, _, value = line.partition(':')
+          if field in totals:
+            totals[field] += int(value.split()[0])
+      processes += 1
+    except OSError:
+      continue
+  return {'pss_mb': round(totals['Pss'] / 1024, 1), 'rss_mb': round(totals['Rss'] / 1024, 1), 'processes': processes}
+
+
+# Start the predictor server in one serving mode
+# Input: mode (str, preload or independent), workers (int), port (int)
+# Output: subprocess.Popen
+def start_server(mode, workers, port):
+  cpus = container_cpu_count()
+  env = {
+    **os.environ,
+    'QUERY_CACHE_SIZE': '0',
+    'PAGE_CACHE_MAX_BYTES': '0',
+    'STARTUP_BENCHMARK': 'false',
+    # Same share of the CPUs per worker in both modes (app.serve applies it by default)
+    'TORCH_THREADS': os.environ.get('TORCH_THREADS', str(max(1, cpus // workers))),
+    'RASTER_WORKERS': os.environ.get('RASTER_WORKERS', str(max(1, cpus // (2 * workers)))),
+    'ENCODE_WORKERS': os.environ.get('ENCODE_WORKERS', str(max(1, cpus // (2 * workers)))),
+    'TEXT_WORKERS': os.environ.get('TEXT_WORKERS', str(max(1, cpus // (2 * workers)))),
+  }
+  if mode == 'preload':
+    env.update({'SERVE_WORKERS': str(workers), 'SERVE_HOST': '127.0.0.1', 'AIP_HTTP_PORT': str(port)})
+    command = [sys.executable, '-m', 'app.serve']
+  else:
+    command = [sys.executable, '-m', 'uvicorn', 'app.main:app', '--host', '127.0.0.1', '--port', str(port)]
+    command += ['--workers', str(workers)]
+  return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# Wait until the workers answer ready: the port is shared, so readiness is only
+# assumed once a run of consecutive health checks all succeed
+# Input: base_url (str), workers (int), timeout (float, seconds)
+# Output: float (seconds until ready)
+def wait_ready(base_url, workers, timeout):
+  start = time.perf_counter()
+  streak = 0
+  while streak < 4 * workers:
+    if time.perf_counter() - start > timeout:
+      raise TimeoutError(f'Server not ready after {timeout}s')
+    try:
+      ready = requests.get(f'{base_url}/health', timeout=5).status_code == 200
+    except requests.RequestException:
+      ready = False
+    streak = streak + 1 if ready else 0
+    if not ready:
+      time.sleep(1)
+  return time.perf_counter() - start
+
+
+# Send predict requests from concurrent clients until the deadline
+# Input: base_url (str), duration (float, seconds), concurrency (int), pdf_base64 (Optional[str])
+# Output: Dict[str, Any] (requests per second, latency percentiles, refused and failed requests)
+def run_load(base_url, duration, concurrency, pdf_base64=None):
+  latencies = []
+  outcomes = {'ok': 0, 'refused': 0, 'failed': 0}
+  lock = threading.Lock()
+  deadline = time.perf_counter() + duration
+
+  def client(client_index):
+    session = requests.Session()
+    request_index = 0
+    while time.perf_counter() < deadline:
+      if pdf_base64 and request_index % 2:
+        instance = {'pdf_base64': pdf_base64, 'pdf_url': 'benchmark.pdf'}
+      else:
+        # Distinct texts, nothing is served from a cache
+        instance = {'query_text': f'benchmark query {client_index} {request_index}'}
+      request_index += 1
+      start = time.perf_counter()
+      try:
+        status = session.post(f'{base_url}/predict', json={'instances': [instance]}, timeout=600).status_code
+      except requests.RequestException:
+        status = None
+      with lock:
+        if status == 200:
+          outcomes['ok'] += 1
+          latencies.append(time.perf_counter() - start)
+        elif status in (429, 503):
+          outcomes['refused'] += 1
+        else:
+          outcomes['failed'] += 1
+
+  start = time.perf_counter()
+  threads = [threading.Thread(target=client, args=(index,)) for index in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - start
+  return {
+    'requests_per_second': round(outcomes['ok'] / elapsed, 2),
+    'p50_latency_ms': round(float(np.percentile(latencies, 50)) * 1000, 1) if latencies else None,
+    'p95_latency_ms': round(float(np.percentile(latencies, 95)) * 1000, 1) if latencies else None,
+    **outcomes,
+  }
+
+
+# Start a server in one mode, measure it and stop it
+# Input: mode (str), args (argparse.Namespace), pdf_base64 (Optional[str])
+# Output: Dict[str, Any]
+def measure(mode, args, pdf_base64):
+  base_url = f'http://127.0.0.1:{args.port}'
+  server = start_server(mode, args.workers, args.port)
+  try:
+    ready_seconds = wait_ready(base_url, args.workers, args.startup_timeout)
+    idle_memory = memory_of(process_tree(server.pid))
+
+    # Peak memory under load, sampled every second
+    peak = {'pss_mb': 0}
+    done = threading.Event()
+
+    def sample():
+      while not done.wait(1):
+        memory = memory_of(process_tree(server.pid))
+        if memory['pss_mb'] > peak['pss_mb']:
+          peak.update(memory)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    load = run_load(base_url, args.duration, args.concurrency or 2 * args.workers, pdf_base64)
+    done.set()
+    sampler.join()
+    return {'ready_seconds': round(ready_seconds, 1), 'idle_memory': idle_memory, 'peak_memory': peak, 'load': load}
+  finally:
+    server.send_signal(signal.SIGTERM)
+    try:
+      server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+      server.kill()
+      server.wait()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Compare preload-and-fork serving with independent workers')
+  parser.add_argument('--workers', type=int, default=2, help='Workers in each mode (default 2)')
+  parser.add_argument('--duration', type=float, default=60, help='Seconds of load per mode (default 60)')
+  parser.add_argument('--concurrency', type=int, help='Concurrent clients (default 2 per worker)')
+  parser.add_argument('--pdf', help='Sample PDF sent inline in every other request (default: queries only)')
+  parser.add_argument('--port', type=int, default=8090, help='Local port of the servers (default 8090)')
+  parser.add_argument('--startup-timeout', type=float, default=900, help='Seconds allowed to load the workers')
+  parser.add_argument('--mode', action='append', choices=['preload', 'independent'], help='Mode (default both)')
+  args = parser.parse_args()
+
+  pdf_base64 = None
+  if args.pdf:
+    with open(args.pdf, 'rb') as f:
+      pdf_base64 = base64.b64encode(f.read()).decode('ascii')
+
+  results = {'workers': args.workers}
+  for mode in args.mode or ['preload', 'independent']:
+    results[mode] = measure(mode, args, pdf_base64)
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
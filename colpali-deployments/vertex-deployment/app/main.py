@@ -1,8 +1,21 @@
 import os
+import asyncio
+import base64
+import binascii
+import json
 import logging
+import time
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+
+from app.utils.batcher import QueryBatcher
+from app.utils.encoding import EMBEDDING_FORMATS
+from app.utils.log_payload import preview
+from app.utils.metrics import REJECTED_REQUESTS, REQUEST_SECONDS
+from app.utils.scheduler import DocumentScheduler, QueueFullError
 
 # Logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -10,46 +23,224 @@ logging.basicConfig(level=logging.INFO)
 # Standard paths for Vertex AI
 AIP_HEALTH_ROUTE = os.environ.get('AIP_HEALTH_ROUTE', '/health')
 AIP_PREDICT_ROUTE = os.environ.get('AIP_PREDICT_ROUTE', '/predict')
+LIVENESS_ROUTE = os.environ.get('LIVENESS_ROUTE', '/live')
 
 app = FastAPI()
 predictor = None
+query_batcher = None
+document_scheduler = None
+
+# Readiness of the predictor: 'starting' while the model loads in the background,
+# then 'ready', or 'failed' if the setup raised
+startup_state = {'status': 'starting', 'error': None, 'timings': {}}
 
 
 # Model for Vertex AI format
 class PredictRequest(BaseModel):
   instances: List[Dict[str, Any]]
+  parameters: Optional[Dict[str, Any]] = None
 
 
-@app.on_event('startup')
-async def startup_event():
-  """Startup event to initialize the model"""
-  global predictor
+# Predictor whose model was loaded before this worker was forked (set by app.serve)
+preloaded_predictor = None
+
+
+def create_predictor():
+  """Imports and sets up the predictor, returns it with the time spent in each startup step"""
+  start = time.perf_counter()
+  from app.utils.predictor import Predictor  # Import only when the server starts
+
+  imports_seconds = round(time.perf_counter() - start, 3)
+  if preloaded_predictor is not None:
+    # The weights are shared with the parent process, only the workers of this process are started
+    new_predictor = preloaded_predictor
+    new_predictor.start_workers()
+  else:
+    new_predictor = Predictor()
+    new_predictor.setup()
+  return new_predictor, {'imports': imports_seconds, **new_predictor.startup_timings}
+
+
+async def load_predictor():
+  """Loads the model off the event loop, so liveness checks are answered meanwhile"""
+  global predictor, query_batcher, document_scheduler
+  start = time.perf_counter()
   try:
-    from app.utils.predictor import Predictor  # Import only when the server starts
+    loaded_predictor, timings = await asyncio.get_running_loop().run_in_executor(None, create_predictor)
 
-    predictor = Predictor()
-    predictor.setup()
-    logging.info('✅ Predictor initialized successfully!')
+    # Concurrent query requests share forward passes through the batcher
+    query_batcher = QueryBatcher(loaded_predictor)
+    query_batcher.start()
+    # Documents are embedded in their own workers, behind a bounded queue
+    document_scheduler = DocumentScheduler()
+    predictor = loaded_predictor
+
+    startup_state['timings'] = {**timings, 'total': round(time.perf_counter() - start, 3)}
+    startup_state['status'] = 'ready'
+    logging.info(f'✅ Predictor initialized successfully! Startup timings: {startup_state["timings"]}')
   except Exception as e:
     logging.error(f'❌ Error during predictor initialization: {e}')
-    raise RuntimeError('Error during model initialization')
+    startup_state['error'] = str(e)
+    startup_state['status'] = 'failed'
+
+
+@app.on_event('startup')
+async def startup_event():
+  """Startup event to start loading the model in the background"""
+  app.state.load_task = asyncio.create_task(load_predictor())
+
+
+@app.on_event('shutdown')
+async def shutdown_event():
+  """Shutdown event to stop the background workers"""
+  if query_batcher is not None:
+    await query_batcher.stop()
+  if document_scheduler is not None:
+    document_scheduler.shutdown()
 
 
 @app.get(AIP_HEALTH_ROUTE)
 async def health():
-  """Health check endpoint"""
-  logging.info('✅ Health check received')
-  return {'status': 'ok'}
+  """
+  Readiness check endpoint (the health route of Vertex AI)
+  - 200 once the model is loaded and warmed up, 503 while starting or after a failed startup.
+  """
+  logging.info(f'✅ Health check received: {startup_state["status"]}')
+  status_code = 200 if startup_state['status'] == 'ready' else 503
+  return JSONResponse(status_code=status_code, content=startup_state)
+
+
+@app.get(LIVENESS_ROUTE)
+async def live():
+  """Liveness check endpoint, answered as soon as the server listens, even while the model loads"""
+  if startup_state['status'] == 'failed':
+    return JSONResponse(status_code=503, content={'status': 'failed'})
+  return {'status': 'alive'}
+
+
+@app.get('/stats')
+async def stats():
+  """Runtime statistics of the predictor workers"""
+  return {
+    'query_batcher': query_batcher.stats() if query_batcher is not None else None,
+    'document_scheduler': document_scheduler.stats() if document_scheduler is not None else None,
+    'query_cache': predictor.query_cache.stats() if predictor is not None else None,
+    'page_cache': predictor.page_store.stats() if predictor is not None and predictor.page_store else None,
+  }
+
+
+@app.get('/metrics')
+async def metrics():
+  """Prometheus metrics: per-stage and per-request latency histograms, rejected requests"""
+  if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    # Several workers serve this port (app.serve), the metrics of all of them are merged
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+  return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def decode_pdf_content(index, instance):
+  """Decodes the inline PDF of a document instance ('pdf_base64'), None when the PDF is to be downloaded"""
+  if 'pdf_base64' not in instance:
+    return None
+  try:
+    return base64.b64decode(instance['pdf_base64'], validate=True)
+  except (binascii.Error, TypeError, ValueError):
+    raise HTTPException(
+      status_code=400,
+      detail=f"Invalid instance {index}: 'pdf_base64' must be base64-encoded PDF bytes",
+    )
+
+
+def parse_page_range(index, instance):
+  """
+  Reads the page range of a document instance ('first_page_index' inclusive, 'last_page_index'
+  exclusive, both 0-based and optional), None when the whole PDF is to be embedded
+  """
+  if 'first_page_index' not in instance and 'last_page_index' not in instance:
+    return None
+  first_page_index = instance.get('first_page_index', 0)
+  last_page_index = instance.get('last_page_index')
+  if (
+    not isinstance(first_page_index, int)
+    or first_page_index < 0
+    or (last_page_index is not None and (not isinstance(last_page_index, int) or last_page_index <= first_page_index))
+  ):
+    raise HTTPException(
+      status_code=400,
+      detail=f"Invalid instance {index}: 'first_page_index' and 'last_page_index' must be a range of page indexes",
+    )
+  return first_page_index, last_page_index
+
+
+class DocumentStreamingResponse(StreamingResponse):
+  """
+  Streaming response of documents admitted in the document queue. Their room is released
+  by the scheduler once the body has started; when the response ends before that (the
+  client went away before the first chunk), it is given back here.
+  """
+
+  def __init__(self, records, document_count, **kwargs):
+    self.document_count = document_count
+    self.started = False
+    super().__init__(self.watch_records(records), **kwargs)
+
+  async def watch_records(self, records):
+    self.started = True
+    try:
+      async for record in records:
+        yield record
+    finally:
+      await records.aclose()
+
+  async def __call__(self, scope, receive, send):
+    try:
+      await super().__call__(scope, receive, send)
+    finally:
+      # Stops a body left mid-stream, and keeps one never started from running later
+      await self.body_iterator.aclose()
+      if not self.started:
+        document_scheduler.withdraw(self.document_count)
+
+
+async def stream_document_records(pdf_urls, embedding_formats, pdf_contents, page_ranges, start):
+  """Yields the NDJSON lines of a streamed document prediction, ending with an error record on failure"""
+  try:
+    async for record in document_scheduler.stream(
+      len(pdf_urls), predictor.stream_documents, pdf_urls, embedding_formats, pdf_contents, page_ranges
+    ):
+      yield json.dumps(record) + '\n'
+    REQUEST_SECONDS.labels('stream').observe(time.perf_counter() - start)
+    logging.info(f'✅ Streamed prediction completed for {len(pdf_urls)} PDFs')
+  except Exception as e:
+    # The status line is already sent, the failure can only be reported in the stream
+    logging.error(f'❌ Error during streamed prediction: {e}')
+    yield json.dumps({'type': 'error', 'detail': f'Internal error: {str(e)}'}) + '\n'
 
 
 @app.post(AIP_PREDICT_ROUTE)
 async def predict(request: PredictRequest):
   """
   Main prediction endpoint for Vertex AI
-  - Supports queries (query_text) and documents (pdf_url).
+  - Supports queries (query_text) and documents (pdf_url, or the PDF itself inline in pdf_base64).
+  - Documents can be limited to a range of pages (first_page_index, last_page_index), so that
+    the pages of a large PDF are shared out between several calls.
+  - Every instance gets one prediction, in the same order as the instances.
+  - Answers 429 with Retry-After when the query or document queue is full.
+  - With `parameters.stream` set, documents are streamed as NDJSON: one 'page' record
+    per page as soon as it is embedded, then a 'summary' record (or an 'error' record).
   """
 
-  logging.info(f'📥 Request received: {request.dict()}')
+  start = time.perf_counter()
+  logging.info(f'📥 Request received: {preview(request.instances)}')
+
+  if startup_state['status'] != 'ready':
+    raise HTTPException(
+      status_code=503,
+      detail=f'Predictor is not ready: {startup_state["status"]}',
+      headers={'Retry-After': '10'},
+    )
 
   try:
     # Verify that the request has at least one instance
@@ -59,25 +250,112 @@ async def predict(request: PredictRequest):
         detail="Invalid request format: 'instances' is required",
       )
 
-    # Take the first instance
-    instance = request.instances[0]
+    # Determine the type of each instance (the endpoint can receive queries and PDF URLs in the same call)
+    query_indexes = []
+    document_indexes = []
+    for index, instance in enumerate(request.instances):
+      if 'query_text' in instance:
+        query_indexes.append(index)
+      elif 'pdf_url' in instance or 'pdf_base64' in instance:
+        document_indexes.append(index)
+      else:
+        raise HTTPException(
+          status_code=400,
+          detail=f"Invalid instance {index}: specify 'query_text', 'pdf_url' or 'pdf_base64'",
+        )
+      if instance.get('embedding_format', 'json') not in EMBEDDING_FORMATS:
+        raise HTTPException(
+          status_code=400,
+          detail=f"Invalid instance {index}: 'embedding_format' must be one of {EMBEDDING_FORMATS}",
+        )
+
+    stream = bool((request.parameters or {}).get('stream'))
+    if stream and query_indexes:
+      raise HTTPException(
+        status_code=400,
+        detail='Invalid request: streaming is only available for document instances',
+      )
+
+    # Inline PDFs are decoded (and rejected if malformed) before the request takes room in a queue
+    pdf_contents = {index: decode_pdf_content(index, request.instances[index]) for index in document_indexes}
+    page_ranges = {index: parse_page_range(index, request.instances[index]) for index in document_indexes}
+
+    # Refuse the whole request upfront if its queries or documents do not fit in the queues
+    if query_indexes:
+      query_batcher.check_capacity(len(query_indexes))
+    if document_indexes:
+      document_scheduler.admit(len(document_indexes))
+
+    if stream:
+      logging.info(f'📥 Streaming request for {len(document_indexes)} PDFs')
+      return DocumentStreamingResponse(
+        stream_document_records(
+          [instance.get('pdf_url') for instance in request.instances],
+          [instance.get('embedding_format', 'json') for instance in request.instances],
+          [pdf_contents[index] for index in document_indexes],
+          [page_ranges[index] for index in document_indexes],
+          start,
+        ),
+        len(document_indexes),
+        media_type='application/x-ndjson',
+      )
+
+    predictions = [None] * len(request.instances)
+
+    document_job = None
+    if document_indexes:
+      logging.info(f'📥 Request for {len(document_indexes)} PDFs')
+      # Embedded in the document workers, off the event loop, while the queries are batched
+      document_job = asyncio.ensure_future(
+        document_scheduler.run(
+          len(document_indexes),
+          predictor.predict_documents,
+          [request.instances[index].get('pdf_url') for index in document_indexes],
+          [request.instances[index].get('embedding_format', 'json') for index in document_indexes],
+          [pdf_contents[index] for index in document_indexes],
+          [page_ranges[index] for index in document_indexes],
+        )
+      )
+
+    if query_indexes:
+      # Queued together, so the batcher embeds them in the same forward pass
+      logging.info(f'📥 Request for {len(query_indexes)} Queries')
+      try:
+        results = await asyncio.gather(
+          *[
+            query_batcher.submit(
+              request.instances[index]['query_text'],
+              request.instances[index].get('embedding_format', 'json'),
+            )
+            for index in query_indexes
+          ]
+        )
+      except BaseException:
+        # The request fails with its queries: its documents are dropped rather than left running unobserved
+        if document_job is not None:
+          document_job.cancel()
+          await asyncio.gather(document_job, return_exceptions=True)
+        raise
+      for index, result in zip(query_indexes, results):
+        predictions[index] = result
 
-    # Determine the type of request (the endpoint can receive either a query or a PDF URL)
-    if 'query_text' in instance:
-      logging.info('📥 Request for Query')
-      result = predictor.predict(mode='query', query_text=instance['query_text'])
-    elif 'pdf_url' in instance:
-      logging.info('📥 Request for PDF')
-      result = predictor.predict(mode='document', pdf_url=instance['pdf_url'])
-    else:
-      raise ValueError("Invalid request format: specify 'query_text' or 'pdf_url'")
+    if document_job is not None:
+      results = await document_job
+      for index, result in zip(document_indexes, results):
+        predictions[index] = result
 
     # Return the result
-    logging.info(f'✅ Prediction completed: {result}')
-    return {'predictions': [result]}
+    kind = 'mixed' if query_indexes and document_indexes else 'query' if query_indexes else 'document'
+    REQUEST_SECONDS.labels(kind).observe(time.perf_counter() - start)
+    logging.info(f'✅ Prediction completed: {preview(predictions)}')
+    return {'predictions': predictions}
   except HTTPException as e:
     logging.error(f'❌ HTTP error during prediction: {e}')
     raise
+  except QueueFullError as e:
+    logging.warning(f'⚠️ Request refused: {e}')
+    REJECTED_REQUESTS.labels(e.queue).inc()
+    raise HTTPException(status_code=429, detail=str(e), headers={'Retry-After': str(e.retry_after)})
   except Exception as e:
     logging.error(f'❌ Error during prediction: {e}')
     raise HTTPException(status_code=500, detail=f'Internal error: {str(e)}')
@@ -0,0 +1,118 @@
+"""
+Preload-and-fork serving: the model is loaded once, then SERVE_WORKERS processes are
+forked from the loaded process and serve the same port.
+
+The workers share the weights copy-on-write instead of each loading its own copy, so
+the resident memory of N workers stays close to that of one. Each worker warms up the
+model and starts its own pipeline threads, text extraction processes, caches and event
+loop. A worker that dies is replaced by a new fork, without reloading the weights.
+
+CPU only: CUDA does not survive a fork, run a single worker per GPU replica instead.
+
+  SERVE_WORKERS=4 python -m app.serve
+"""
+
+import gc
+import glob
+import logging
+import os
+import signal
+import tempfile
+import time
+
+import uvicorn
+
+from app.utils.cpu_profile import container_cpu_count
+
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', 2))
+SERVE_HOST = os.environ.get('SERVE_HOST', '0.0.0.0')
+SERVE_PORT = int(os.environ.get('AIP_HTTP_PORT', 8080))
+SERVE_KEEP_ALIVE_SECONDS = 300
+
+
+# Share out the per-process defaults between the workers, so that N workers do not
+# each size their thread pools for the whole container. Must run before the
+# predictor (and prometheus_client) are imported.
+# Input: workers (int)
+def configure_worker_environment(workers):
+  cpus = container_cpu_count()
+  os.environ.setdefault('TORCH_THREADS', str(max(1, cpus // workers)))
+  for name in ('RASTER_WORKERS', 'ENCODE_WORKERS', 'TEXT_WORKERS'):
+    os.environ.setdefault(name, str(max(1, cpus // (2 * workers))))
+
+  if workers > 1:
+    # Metrics are written by every worker to files merged by the /metrics route
+    metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='colpali-metrics-'))
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+      os.remove(path)
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  configure_worker_environment(SERVE_WORKERS)
+
+  import torch
+
+  if SERVE_WORKERS > 1 and torch.cuda.is_available():
+    raise SystemExit('❌ CUDA cannot be shared with forked workers, use SERVE_WORKERS=1 on GPU replicas')
+
+  import app.main as server
+  from app.utils.predictor import Predictor
+
+  config = uvicorn.Config(server.app, host=SERVE_HOST, port=SERVE_PORT, timeout_keep_alive=SERVE_KEEP_ALIVE_SECONDS)
+  # Bound before the model loads: connections wait in the backlog instead of being refused
+  sock = config.bind_socket()
+
+  predictor = Predictor()
+  # Single-threaded, so that no OpenMP thread pool exists when the workers are forked
+  predictor.load_model(for_fork=True)
+  server.preloaded_predictor = predictor
+  # Objects created so far (most of them by the model) are ignored by the garbage
+  # collector of the workers, which would otherwise write to their pages and unshare them
+  gc.freeze()
+
+  workers = set()
+  stopping = False
+
+  def fork_worker():
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+      try:
+        uvicorn.Server(config).run(sockets=[sock])
+      finally:
+        os._exit(0)
+    logging.info(f'🍴 Forked worker {pid}')
+    workers.add(pid)
+
+  def stop(signum, frame):
+    nonlocal stopping
+    stopping = True
+    logging.info(f'🛑 Stopping {len(workers)} workers')
+    for pid in workers:
+      os.kill(pid, signal.SIGTERM)
+
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  for _ in range(SERVE_WORKERS):
+    fork_worker()
+
+  while workers:
+    pid, status = os.wait()
+    workers.discard(pid)
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+      from prometheus_client import multiprocess
+
+      multiprocess.mark_process_dead(pid)
+    if stopping:
+      continue
+    logging.warning(f'⚠️ Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}, forking a new one')
+    time.sleep(1)
+    if not stopping:
+      fork_worker()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.utils.scheduler import QueueFullError
+
+# Queries arriving within QUERY_BATCH_WAIT_MS of the first one are embedded
+# together, up to QUERY_BATCH_MAX_SIZE queries per forward pass. At most
+# QUERY_QUEUE_SIZE queries may wait for a batch, beyond that they are refused.
+QUERY_BATCH_MAX_SIZE = int(os.environ.get('QUERY_BATCH_MAX_SIZE', 16))
+QUERY_BATCH_WAIT_MS = float(os.environ.get('QUERY_BATCH_WAIT_MS', 5))
+QUERY_QUEUE_SIZE = int(os.environ.get('QUERY_QUEUE_SIZE', 256))
+
+
+class QueryBatcher:
+  """
+  Dynamic micro-batcher in front of the query mode of the predictor.
+
+  Concurrent `submit` calls are queued, collected into a single padded batch
+  and embedded with one forward pass in a dedicated worker thread; each caller
+  then gets back its own query result. The queue is bounded: queries that do
+  not fit raise `QueueFullError`.
+  """
+
+  def __init__(
+    self,
+    predictor,
+    max_batch_size=QUERY_BATCH_MAX_SIZE,
+    max_wait_ms=QUERY_BATCH_WAIT_MS,
+    max_queue_size=QUERY_QUEUE_SIZE,
+  ):
+    self.predictor = predictor
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self.max_queue_size = max_queue_size
+    self._queue = None
+    self._task = None
+    self._executor = None
+
+    self.batches = 0
+    self.queries = 0
+    self.rejected = 0
+    self.queue_seconds_total = 0.0
+    self.queue_seconds_max = 0.0
+
+  def start(self):
+    self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query')
+    self._task = asyncio.create_task(self._run())
+    logging.info(f'📦 Query batcher started: max batch {self.max_batch_size}, wait {self.max_wait * 1000:.1f} ms')
+
+  async def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      try:
+        await self._task
+      except asyncio.CancelledError:
+        pass
+      self._task = None
+    if self._executor is not None:
+      self._executor.shutdown(wait=False, cancel_futures=True)
+      self._executor = None
+
+  # Refuse upfront a request whose queries would not all fit in the queue
+  # Input: query_count (int)
+  def check_capacity(self, query_count):
+    if self._queue.qsize() + query_count > self.max_queue_size:
+      self.rejected += 1
+      raise QueueFullError(
+        f'Query queue is full: {self._queue.qsize()}/{self.max_queue_size} queries waiting', 'query', 1
+      )
+
+  # Queue a query and wait for its embedding
+  # Input: query_text (str), embedding_format (str)
+  # Output: Dict[str, Any] (same format as Predictor.predict in query mode)
+  async def submit(self, query_text, embedding_format='json'):
+    if self._task is None:
+      raise RuntimeError('Query batcher is not running')
+    # Cached queries are answered right away, without waiting for a batch
+    result = self.predictor.lookup_query(query_text, embedding_format)
+    if result is not None:
+      return result
+    future = asyncio.get_running_loop().create_future()
+    try:
+      self._queue.put_nowait((query_text, embedding_format, time.perf_counter(), future))
+    except asyncio.QueueFull:
+      self.rejected += 1
+      raise QueueFullError(f'Query queue is full: {self.max_queue_size} queries waiting', 'query', 1)
+    return await future
+
+  def stats(self):
+    return {
+      'batches': self.batches,
+      'queries': self.queries,
+      'max_batch_size': self.max_batch_size,
+      'avg_batch_size': round(self.queries / self.batches, 2) if self.batches else None,
+      'avg_batch_fill': round(self.queries / (self.batches * self.max_batch_size), 3) if self.batches else None,
+      'avg_queue_ms': round(self.queue_seconds_total / self.queries * 1000, 2) if self.queries else None,
+      'max_queue_ms': round(self.queue_seconds_max * 1000, 2),
+      'queued': self._queue.qsize() if self._queue is not None else 0,
+      'max_queue_size': self.max_queue_size,
+      'rejected': self.rejected,
+    }
+
+  async def _collect_batch(self):
+    loop = asyncio.get_running_loop()
+    batch = [await self._queue.get()]
+    deadline = loop.time() + self.max_wait
+    while len(batch) < self.max_batch_size:
+      timeout = deadline - loop.time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+      except asyncio.TimeoutError:
+        break
+    # Whatever queued up meanwhile rides along without extra waiting
+    while len(batch) < self.max_batch_size and not self._queue.empty():
+      batch.append(self._queue.get_nowait())
+    return batch
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = await self._collect_batch()
+      # Callers that went away while queued do not need a forward pass
+      batch = [item for item in batch if not item[3].done()]
+      if not batch:
+        continue
+
+      dispatched_at = time.perf_counter()
+      for _, _, queued_at, _ in batch:
+        queue_seconds = dispatched_at - queued_at
+        self.queue_seconds_total += queue_seconds
+        self.queue_seconds_max = max(self.queue_seconds_max, queue_seconds)
+      self.batches += 1
+      self.queries += len(batch)
+      logging.info(f'📦 Embedding batch of {len(batch)}/{self.max_batch_size} queries')
+
+      try:
+        results = await loop.run_in_executor(
+          self._executor,
+          self.predictor.predict_queries,
+          [text for text, _, _, _ in batch],
+          [embedding_format for _, embedding_format, _, _ in batch],
+        )
+      except Exception as e:
+        logging.error(f'❌ Error during batched query prediction: {e}')
+        for _, _, _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+        continue
+
+      for (_, _, _, future), result in zip(batch, results):
+        if not future.done():
+          future.set_result(result)
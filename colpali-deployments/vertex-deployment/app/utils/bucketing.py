@@ -0,0 +1,23 @@
+import os
+
+# Visual tokens (summed over the pages of a batch) allowed in one forward pass of
+# document pages. Pages are only batched with pages of the same token grid, so the
+# batch size follows from the size of their grid instead of being fixed.
+PAGE_BATCH_TOKEN_BUDGET = int(os.environ.get('PAGE_BATCH_TOKEN_BUDGET', 1024))
+
+
+# Split pages into batches of pages sharing the same token grid (so that no page is
+# padded to a larger one), each batch holding at most token_budget tokens and at
+# least one page. Buckets come in the order of their first page.
+# Input: grids (List[tuple], one token grid per page), token_budget (int)
+# Output: List[List[int]] (page indexes of each batch)
+def bucket_batches(grids, token_budget=PAGE_BATCH_TOKEN_BUDGET):
+  buckets = {}
+  for index, grid in enumerate(grids):
+    buckets.setdefault(grid, []).append(index)
+
+  batches = []
+  for (rows, columns), indexes in buckets.items():
+    batch_size = max(1, token_budget // (rows * columns))
+    batches.extend(indexes[start : start + batch_size] for start in range(0, len(indexes), batch_size))
+  return batches
@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+  """
+  Thread-safe, size-bounded LRU cache with an optional time-to-live.
+
+  A `max_size` of 0 disables the cache, a `ttl_seconds` of 0 keeps entries
+  until they are evicted by newer ones.
+  """
+
+  def __init__(self, max_size, ttl_seconds=0):
+    self.max_size = max_size
+    self.ttl_seconds = ttl_seconds
+    self._lock = threading.Lock()
+    self._entries = OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key, record_stats=True):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and self.ttl_seconds and time.monotonic() - entry[1] > self.ttl_seconds:
+        del self._entries[key]
+        self.expirations += 1
+        entry = None
+      if entry is None:
+        if record_stats:
+          self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      if record_stats:
+        self.hits += 1
+      return entry[0]
+
+  def put(self, key, value):
+    if self.max_size <= 0:
+      return
+    with self._lock:
+      self._entries[key] = (value, time.monotonic())
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'size': len(self._entries),
+        'max_size': self.max_size,
+        'ttl_seconds': self.ttl_seconds,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        'evictions': self.evictions,
+        'expirations': self.expirations,
+      }
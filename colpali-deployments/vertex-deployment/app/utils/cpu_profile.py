@@ -0,0 +1,48 @@
+import os
+
+
+# Read the CPU quota of the container from its cgroup (v2, then v1)
+# Output: Optional[float] (CPUs granted, None when the container is not limited)
+def _cgroup_cpu_quota():
+  try:
+    with open('/sys/fs/cgroup/cpu.max') as f:
+      quota, period = f.read().split()
+    return None if quota == 'max' else int(quota) / int(period)
+  except (OSError, ValueError):
+    pass
+  try:
+    with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+      quota = int(f.read())
+    with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+      period = int(f.read())
+    return None if quota <= 0 else quota / period
+  except (OSError, ValueError):
+    return None
+
+
+# Number of CPUs this container may actually use. os.cpu_count() reports the
+# cores of the host, which oversubscribes a container limited by a CPU quota.
+# Output: int
+def container_cpu_count():
+  if hasattr(os, 'sched_getaffinity'):
+    cpus = len(os.sched_getaffinity(0))
+  else:
+    cpus = os.cpu_count() or 1
+  quota = _cgroup_cpu_quota()
+  if quota is not None:
+    cpus = min(cpus, max(1, int(quota)))
+  return cpus
+
+
+# Tell whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX on
+# x86, BF16 on Arm). Without them bfloat16 matmuls are emulated and slower than float32.
+# Output: bool
+def cpu_supports_bfloat16():
+  try:
+    with open('/proc/cpuinfo') as f:
+      for line in f:
+        if line.startswith(('flags', 'Features')):
+          return bool({'avx512_bf16', 'amx_bf16', 'bf16'} & set(line.split(':', 1)[1].split()))
+  except OSError:
+    pass
+  return False
@@ -0,0 +1,124 @@
+import logging
+import os
+import tempfile
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Documents are streamed to their document file (see create_document_file) and refused
+# above DOWNLOAD_MAX_BYTES. The timeouts bound the connection and each wait for data, not
+# the whole transfer, so a large document on a slow link completes as long as bytes keep
+# coming. An interrupted transfer is resumed with a Range request up to
+# DOWNLOAD_RESUME_ATTEMPTS times.
+DOWNLOAD_MAX_BYTES = int(os.environ.get('DOWNLOAD_MAX_BYTES', 256 * 1024**2))
+DOWNLOAD_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('DOWNLOAD_CONNECT_TIMEOUT_SECONDS', 10))
+DOWNLOAD_READ_TIMEOUT_SECONDS = float(os.environ.get('DOWNLOAD_READ_TIMEOUT_SECONDS', 30))
+DOWNLOAD_RESUME_ATTEMPTS = int(os.environ.get('DOWNLOAD_RESUME_ATTEMPTS', 3))
+DOWNLOAD_POOL_SIZE = int(os.environ.get('DOWNLOAD_POOL_SIZE', 8))
+
+# Directory of the document files, the system temporary directory by default
+DOCUMENT_DIR = os.environ.get('DOCUMENT_DIR') or None
+
+CHUNK_BYTES = 64 * 1024
+
+
+class DownloadError(Exception):
+  """
+  Raised when a document cannot be downloaded: error status, too large, or interrupted too many times.
+  """
+
+
+# Create the named file holding a document while it is predicted: the rasterizer and the
+# text extraction processes read their pages from it by path, the document is written once.
+# The caller deletes it once the document is done.
+# Output: file object (NamedTemporaryFile opened for writing, not deleted on close)
+def create_document_file():
+  return tempfile.NamedTemporaryFile(prefix='colpali-', suffix='.pdf', dir=DOCUMENT_DIR, delete=False)
+
+
+# Create the HTTP session shared by the downloads: connections are kept alive and
+# reused, and failed connections or transient error statuses are retried with backoff
+# Output: requests.Session
+def create_session():
+  retry = Retry(
+    total=DOWNLOAD_RESUME_ATTEMPTS,
+    read=0,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(['GET']),
+    raise_on_status=False,
+  )
+  adapter = HTTPAdapter(pool_connections=DOWNLOAD_POOL_SIZE, pool_maxsize=DOWNLOAD_POOL_SIZE, max_retries=retry)
+  session = requests.Session()
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  return session
+
+
+# Total size of the document announced by a response, if any
+# Input: response (requests.Response), offset (int, first byte of the response body)
+# Output: Optional[int]
+def _announced_size(response, offset):
+  if response.status_code == 206:
+    # Content-Range: bytes <first>-<last>/<total or *>
+    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+  length = response.headers.get('Content-Length')
+  return offset + int(length) if length and length.isdigit() else None
+
+
+# Stream a document to a file, resuming interrupted transfers
+# Input: session (requests.Session), url (str), document_file (binary file object, empty), max_bytes (int)
+# Output: int (size in bytes)
+def download_to_file(session, url, document_file, max_bytes=DOWNLOAD_MAX_BYTES):
+  received = 0
+  validator = None
+  attempts = 0
+  start = time.perf_counter()
+  while True:
+    # Bytes are counted as sent, so the offsets of a Range request match the file
+    headers = {'Accept-Encoding': 'identity'}
+    if received:
+      headers['Range'] = f'bytes={received}-'
+      if validator:
+        # The server answers with the whole document if it changed since the first request
+        headers['If-Range'] = validator
+    try:
+      with session.get(
+        url,
+        headers=headers,
+        stream=True,
+        timeout=(DOWNLOAD_CONNECT_TIMEOUT_SECONDS, DOWNLOAD_READ_TIMEOUT_SECONDS),
+      ) as response:
+        if received and response.status_code == 200:
+          logging.warning('⚠️ Server did not resume the download, starting over')
+          document_file.seek(0)
+          document_file.truncate()
+          received = 0
+        elif response.status_code not in (200, 206) or (response.status_code == 206 and not received):
+          raise DownloadError(f'Download failed with status code: {response.status_code}')
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+        size = _announced_size(response, received)
+        if size is not None and size > max_bytes:
+          raise DownloadError(f'Document is too large: {size} bytes, the limit is {max_bytes}')
+        for chunk in response.iter_content(CHUNK_BYTES):
+          received += len(chunk)
+          if received > max_bytes:
+            raise DownloadError(f'Document is too large: over {max_bytes} bytes')
+          document_file.write(chunk)
+      if size is not None and received < size:
+        raise requests.exceptions.ChunkedEncodingError(f'Connection closed after {received}/{size} bytes')
+      break
+    except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+      attempts += 1
+      if attempts > DOWNLOAD_RESUME_ATTEMPTS:
+        raise DownloadError(f'Download failed after {attempts} attempts: {e}')
+      logging.warning(f'⚠️ Download interrupted at {received} bytes ({e}), resuming (attempt {attempts})')
+      time.sleep(0.5 * attempts)
+
+  seconds = time.perf_counter() - start
+  logging.info(f'📥 Downloaded {received} bytes in {seconds:.2f}s ({received / max(seconds, 1e-6) / 1024**2:.1f} MB/s)')
+  return received
@@ -0,0 +1,36 @@
+import base64
+
+import numpy as np
+
+# Wire formats of the embeddings in a prediction:
+# - json: nested lists of floats (default, compatible with every client)
+# - float16 / bfloat16: base64 little-endian 16-bit floats with shape metadata
+# - binary: base64 bits of (value > 0), packed 8 per byte along the last axis
+EMBEDDING_FORMATS = ('json', 'float16', 'bfloat16', 'binary')
+
+
+# Encode one multi-vector embedding in the requested wire format
+# Input: embedding (torch.Tensor, shape [vectors, dim]), embedding_format (str)
+# Output: Union[List[List[float]], Dict[str, Any]] (encoded embedding)
+def encode_embedding(embedding, embedding_format='json'):
+  if embedding_format == 'json':
+    return embedding.tolist()
+
+  # Imported here so that the API server can start listening before torch is loaded
+  import torch
+
+  if embedding_format == 'float16':
+    array = embedding.to(torch.float16).numpy().astype('<f2', copy=False)
+  elif embedding_format == 'bfloat16':
+    # NumPy has no bfloat16: ship the raw 16-bit patterns, decoders shift them into float32
+    array = embedding.to(torch.bfloat16).view(torch.int16).numpy().astype('<i2', copy=False)
+  elif embedding_format == 'binary':
+    array = np.packbits(embedding.float().numpy() > 0, axis=-1)
+  else:
+    raise ValueError(f'Unknown embedding format: {embedding_format}, expected one of {EMBEDDING_FORMATS}')
+
+  return {
+    'dtype': embedding_format,
+    'shape': list(embedding.shape),
+    'data': base64.b64encode(array.tobytes()).decode('ascii'),
+  }
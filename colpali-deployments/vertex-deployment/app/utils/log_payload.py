@@ -0,0 +1,48 @@
+import os
+
+# Maximum number of characters of a request or prediction payload written to the logs
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get('LOG_PAYLOAD_MAX_CHARS', 1000))
+
+
+# Short textual preview of a payload for the logs. The payload is walked only
+# until the budget is spent, so a prediction holding megabytes of embeddings or
+# base64 images costs no more to log than a small one.
+# Input: value (Any, JSON-like), limit (int, characters)
+# Output: str
+def preview(value, limit=LOG_PAYLOAD_MAX_CHARS):
+  parts = []
+  budget = [limit]
+
+  def emit(text):
+    parts.append(text[: budget[0]])
+    budget[0] -= len(text)
+
+  def write(item):
+    if budget[0] <= 0:
+      return
+    if isinstance(item, dict):
+      emit('{')
+      for index, (key, child) in enumerate(item.items()):
+        if budget[0] <= 0:
+          break
+        emit(f'{", " if index else ""}{key!r}: ')
+        write(child)
+      emit('}')
+    elif isinstance(item, (list, tuple)):
+      emit('[')
+      for index, child in enumerate(item):
+        if budget[0] <= 0:
+          break
+        if index:
+          emit(', ')
+        write(child)
+      emit(']')
+    elif isinstance(item, str):
+      # Sliced before repr, so a huge string is never copied whole
+      emit(repr(item[: max(budget[0], 0) + 1]))
+    else:
+      emit(repr(item))
+
+  write(value)
+  text = ''.join(parts)
+  return text if budget[0] >= 0 else f'{text}... (truncated to {limit} chars)'
@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+
+# Latencies span a cached query (milliseconds) to a long document (minutes)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+  'colpali_stage_seconds',
+  'Time spent in one run of a predictor stage (a document download, a window of pages, a forward pass...)',
+  ['mode', 'stage'],
+  buckets=LATENCY_BUCKETS,
+)
+STAGE_PAGES = Counter(
+  'colpali_stage_pages_total',
+  'Pages (document mode) or queries (query mode) processed by a predictor stage',
+  ['mode', 'stage'],
+)
+REQUEST_SECONDS = Histogram(
+  'colpali_request_seconds',
+  'Latency of predict requests, by the kind of instances they carry',
+  ['kind'],
+  buckets=LATENCY_BUCKETS,
+)
+REJECTED_REQUESTS = Counter(
+  'colpali_rejected_requests_total',
+  'Predict requests refused because an inference queue was full',
+  ['queue'],
+)
+
+
+# Record one run of a stage
+# Input: mode (str, document or query), stage (str), seconds (float), items (int, pages or queries)
+def observe_stage(mode, stage, seconds, items=0):
+  STAGE_SECONDS.labels(mode, stage).observe(seconds)
+  if items:
+    STAGE_PAGES.labels(mode, stage).inc(items)
+
+
+# Time the enclosed block as one run of a stage
+# Input: mode (str), stage (str), items (int)
+@contextmanager
+def timed_stage(mode, stage, items=0):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe_stage(mode, stage, time.perf_counter() - start, items)
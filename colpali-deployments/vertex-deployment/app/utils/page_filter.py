@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+# Both filters are opt-in: a sparse page (a single word, light-gray text) can measure as
+# blank, and different sparse pages can hash a few bits apart.
+#
+# Pages whose ink covers less than BLANK_PAGE_INK_RATIO of their surface and that have no
+# extracted text are blank separators: they are neither embedded nor returned. 0 (the
+# default) disables the check.
+BLANK_PAGE_INK_RATIO = float(os.environ.get('BLANK_PAGE_INK_RATIO', 0))
+
+# A page whose difference hash is within DUPLICATE_PAGE_MAX_DISTANCE bits (out of
+# HASH_SIZE * HASH_SIZE) of a page already embedded in the same document, and which has
+# the same model image or the same non-empty extracted text, reuses the embedding of that
+# page instead of running the model. -1 (the default) disables the check.
+DUPLICATE_PAGE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_PAGE_MAX_DISTANCE', -1))
+
+PAGE_FILTERS_ENABLED = BLANK_PAGE_INK_RATIO > 0 or DUPLICATE_PAGE_MAX_DISTANCE >= 0
+
+HASH_SIZE = 16
+
+# A pixel is ink when it is this much darker (or lighter, on dark slides) than the background
+INK_CONTRAST = 64
+
+
+# Share of a page covered by ink, the background being its median luminance
+# Input: image (PIL.Image)
+# Output: float (0 to 1)
+def ink_ratio(image):
+  histogram = image.convert('L').histogram()
+  total = sum(histogram)
+  cumulative = 0
+  for background, count in enumerate(histogram):
+    cumulative += count
+    if cumulative * 2 >= total:
+      break
+  ink = sum(histogram[: max(0, background - INK_CONTRAST)]) + sum(histogram[background + INK_CONTRAST + 1 :])
+  return ink / total
+
+
+# Perceptual hash of a page: the sign of the horizontal luminance gradient on a
+# HASH_SIZE x HASH_SIZE grayscale thumbnail. Near-identical renders differ by a few bits.
+# Input: image (PIL.Image)
+# Output: int (HASH_SIZE * HASH_SIZE bits)
+def difference_hash(image):
+  pixels = np.asarray(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+  bits = pixels[:, 1:] > pixels[:, :-1]
+  return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+# Find the closest page already embedded within max_distance bits of a hash
+# Input: page_hash (int), embedded_hashes (List[tuple (int hash, int page index)]), max_distance (int)
+# Output: Optional[int] (page index of the duplicate, None if there is none)
+def find_duplicate(page_hash, embedded_hashes, max_distance=DUPLICATE_PAGE_MAX_DISTANCE):
+  best_page_index, best_distance = None, max_distance + 1
+  for embedded_hash, page_index in embedded_hashes:
+    distance = bin(page_hash ^ embedded_hash).count('1')
+    if distance < best_distance:
+      best_page_index, best_distance = page_index, distance
+  return best_page_index
@@ -0,0 +1,147 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class PageEmbeddingStore:
+  """
+  Content-addressed, size-bounded store of page embeddings on local disk.
+
+  Pages are keyed by a hash of the model name and of the rendered page image,
+  so an unchanged page of a re-uploaded document maps to the same entry. Each
+  embedding is a float32 `.npy` file opened memory-mapped; an SQLite index keeps
+  the size and last access of every entry and the least recently used ones are
+  evicted once the store grows past `max_bytes`.
+
+  Several processes (the forked serving workers) can share the same root: writes
+  take SQLite's write lock, and the size of the store is read from the index in
+  the same transaction, so the budget holds for all of them together.
+  """
+
+  def __init__(self, root, max_bytes):
+    self.root = root
+    self.max_bytes = max_bytes
+    os.makedirs(root, exist_ok=True)
+
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(os.path.join(root, 'index.sqlite'), timeout=30, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, nbytes INTEGER, last_access REAL)')
+    self._db.execute('CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)')
+    self._db.commit()
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  # Hash a rendered page so that identical pages share a key
+  # Input: model_name (str), image (PIL.Image, the model input)
+  # Output: str (hex digest)
+  @staticmethod
+  def page_key(model_name, image):
+    digest = hashlib.sha256()
+    digest.update(model_name.encode())
+    digest.update(f'{image.mode}:{image.size[0]}x{image.size[1]}'.encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.root, key[:2], f'{key}.npy')
+
+  # Input: key (str)
+  # Output: Optional[np.ndarray] (memory-mapped float32 embedding, None if not stored)
+  def get(self, key):
+    with self._lock:
+      row = self._db.execute('SELECT 1 FROM pages WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      try:
+        embedding = np.load(self._path(key), mmap_mode='r')
+      except (OSError, ValueError) as e:
+        logging.warning(f'⚠️ Dropping unreadable page cache entry {key}: {e}')
+        self._delete(key)
+        self._db.commit()
+        self.misses += 1
+        return None
+      self._db.execute('UPDATE pages SET last_access = ? WHERE key = ?', (time.time(), key))
+      self._db.commit()
+      self.hits += 1
+      return embedding
+
+  # Input: key (str), embedding (np.ndarray)
+  def put(self, key, embedding):
+    embedding = np.ascontiguousarray(embedding, dtype=np.float32)
+    path = self._path(key)
+    with self._lock:
+      if self._db.execute('SELECT 1 FROM pages WHERE key = ?', (key,)).fetchone() is not None:
+        return
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # Write then rename, so a reader never maps a half-written file. Another process may
+      # write the same page at the same time: the temporary name is unique to this thread
+      # of this process, and both renames leave the same content in place.
+      temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+      try:
+        with open(temp_path, 'wb') as f:
+          np.save(f, embedding)
+        os.replace(temp_path, path)
+      except BaseException:
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+        raise
+      nbytes = os.path.getsize(path)
+      # Hold the write lock from the insert to the end of the eviction
+      self._db.execute('BEGIN IMMEDIATE')
+      try:
+        self._db.execute(
+          'INSERT OR IGNORE INTO pages (key, nbytes, last_access) VALUES (?, ?, ?)', (key, nbytes, time.time())
+        )
+        self._evict()
+        self._db.commit()
+      except BaseException:
+        self._db.rollback()
+        raise
+
+  # Size of every entry of the store, whichever process wrote it
+  # Output: int (bytes)
+  def _total_bytes(self):
+    return self._db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM pages').fetchone()[0]
+
+  def _delete(self, key):
+    self._db.execute('DELETE FROM pages WHERE key = ?', (key,))
+    try:
+      os.remove(self._path(key))
+    except FileNotFoundError:
+      pass
+
+  def _evict(self):
+    total_bytes = self._total_bytes()
+    while total_bytes > self.max_bytes:
+      row = self._db.execute('SELECT key, nbytes FROM pages ORDER BY last_access LIMIT 1').fetchone()
+      if row is None:
+        break
+      key, nbytes = row
+      self._delete(key)
+      total_bytes -= nbytes
+      self.evictions += 1
+
+  def stats(self):
+    with self._lock:
+      entries = self._db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+      total_bytes = self._total_bytes()
+      lookups = self.hits + self.misses
+      return {
+        'entries': entries,
+        'bytes': total_bytes,
+        'max_bytes': self.max_bytes,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        'evictions': self.evictions,
+      }
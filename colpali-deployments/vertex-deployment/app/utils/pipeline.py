@@ -0,0 +1,54 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from app.utils.metrics import observe_stage
+
+
+class PipelineStats:
+  """
+  Thread-safe accumulator of busy time and processed pages per pipeline stage.
+
+  Stages running in worker pools record the time spent by each worker, so the
+  `pages_per_second` of a stage is the throughput of a single worker. The
+  `total` entry reports the wall-clock throughput of the whole document.
+  Every recorded run is also exported to the document mode stage histogram.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stages = {}
+    self._start_time = time.perf_counter()
+
+  @contextmanager
+  def stage(self, name, pages=0):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(name, time.perf_counter() - start, pages)
+
+  def record(self, name, seconds, pages=0):
+    observe_stage('document', name, seconds, pages)
+    with self._lock:
+      stage = self._stages.setdefault(name, {'seconds': 0.0, 'pages': 0})
+      stage['seconds'] += seconds
+      stage['pages'] += pages
+
+  def report(self, pages):
+    wall_time = time.perf_counter() - self._start_time
+    with self._lock:
+      report = {
+        name: {
+          'seconds': round(stage['seconds'], 3),
+          'pages': stage['pages'],
+          'pages_per_second': round(stage['pages'] / stage['seconds'], 2) if stage['seconds'] > 0 else None,
+        }
+        for name, stage in self._stages.items()
+      }
+    report['total'] = {
+      'seconds': round(wall_time, 3),
+      'pages': pages,
+      'pages_per_second': round(pages / wall_time, 2) if wall_time > 0 else None,
+    }
+    return report
@@ -0,0 +1,25 @@
+import numpy as np
+import torch
+from scipy.cluster.hierarchy import fcluster, linkage
+
+
+# Shrink the patch vectors of one page by hierarchical clustering: similar
+# vectors (e.g. the many patches of a white margin) are merged with Ward
+# linkage into len(vectors) / pool_factor clusters, and each cluster is
+# replaced by the re-normalized mean of its members.
+# Input: embedding (torch.Tensor [vectors, dim]), pool_factor (int)
+# Output: torch.Tensor [pooled vectors, dim] (same dtype as the input)
+def pool_embedding(embedding, pool_factor):
+  vectors = embedding.float().numpy()
+  # Padding positions of a batched page come out of the model as zero vectors
+  vectors = vectors[np.linalg.norm(vectors, axis=1) > 0]
+  cluster_count = max(1, len(vectors) // pool_factor)
+  if pool_factor <= 1 or len(vectors) <= cluster_count:
+    return torch.from_numpy(vectors).to(embedding.dtype)
+
+  # Vectors are unit length, so Euclidean Ward merges the most cosine-similar groups first
+  clusters = fcluster(linkage(vectors, method='ward'), t=cluster_count, criterion='maxclust') - 1
+  pooled = np.zeros((clusters.max() + 1, vectors.shape[1]), dtype=np.float32)
+  np.add.at(pooled, clusters, vectors)
+  pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+  return torch.from_numpy(pooled).to(embedding.dtype)
@@ -1,19 +1,95 @@
+import numpy as np
 import torch
-from pdf2image import convert_from_bytes
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pdf2image import convert_from_path
+from PIL import Image
 from pypdf import PdfReader
 from io import BytesIO
 import base64
 from colpali_engine.models import ColQwen2, ColQwen2Processor
-import requests
 from typing import Dict, Any, List, Union, Literal, Optional
 from enum import Enum
 from pydantic import BaseModel
 import os
 import time
 import logging
+import unicodedata
+
+from app.utils.bucketing import PAGE_BATCH_TOKEN_BUDGET, bucket_batches
+from app.utils.cache import LRUCache
+from app.utils.cpu_profile import container_cpu_count, cpu_supports_bfloat16
+from app.utils.download import create_document_file, create_session, download_to_file
+from app.utils.encoding import encode_embedding
+from app.utils.metrics import observe_stage, timed_stage
+from app.utils.page_filter import (
+  BLANK_PAGE_INK_RATIO,
+  DUPLICATE_PAGE_MAX_DISTANCE,
+  PAGE_FILTERS_ENABLED,
+  difference_hash,
+  find_duplicate,
+  ink_ratio,
+)
+from app.utils.page_store import PageEmbeddingStore
+from app.utils.pipeline import PipelineStats
+from app.utils.pooling import pool_embedding
+from app.utils.scheduler import PriorityLock
+from app.utils.text_extraction import extract_page_texts
 
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
+# Pages are rendered once at the height of the thumbnail stored in Vespa and
+# returned in the response, then downscaled once to the height fed to the model.
+THUMBNAIL_HEIGHT = int(os.environ.get('THUMBNAIL_HEIGHT', 640))
+MODEL_IMAGE_HEIGHT = int(os.environ.get('MODEL_IMAGE_HEIGHT', 300))
+
+# Number of pages rasterized, embedded and released together in document mode.
+# Peak memory is bounded by this window instead of by the length of the document.
+PAGE_WINDOW_SIZE = int(os.environ.get('PAGE_WINDOW_SIZE', 8))
+
+# Document mode pipeline: rasterization and JPEG encoding run in worker threads
+# (poppler and PIL release the GIL) while the model embeds the current window.
+# PIPELINE_DEPTH bounds how many windows are rasterized ahead of the model.
+RASTER_WORKERS = int(os.environ.get('RASTER_WORKERS', max(1, container_cpu_count() // 2)))
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', max(1, container_cpu_count() // 2)))
+PIPELINE_DEPTH = int(os.environ.get('PIPELINE_DEPTH', 2))
+
+# Text extraction runs in a process pool concurrently with rasterization, one
+# task per window of pages; each page gets TEXT_PAGE_TIMEOUT_SECONDS at most.
+TEXT_WORKERS = int(os.environ.get('TEXT_WORKERS', max(1, container_cpu_count() // 2)))
+TEXT_PAGE_TIMEOUT_SECONDS = float(os.environ.get('TEXT_PAGE_TIMEOUT_SECONDS', 20))
+
+# In-process cache of query embeddings, keyed by model name and normalized query text.
+# A size of 0 disables the cache, a TTL of 0 keeps entries until they are evicted.
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 4096))
+QUERY_CACHE_TTL_SECONDS = float(os.environ.get('QUERY_CACHE_TTL_SECONDS', 0))
+
+# On-disk, content-addressed cache of page embeddings: unchanged pages of a
+# re-uploaded document skip the forward pass. A budget of 0 disables it.
+PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', '/tmp/colpali-page-cache')
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 1024**3))
+
+# Hierarchical pooling of the patch vectors of each page in document mode: a
+# factor of N keeps about 1/N of the vectors. A factor of 1 disables pooling.
+TOKEN_POOL_FACTOR = int(os.environ.get('TOKEN_POOL_FACTOR', 1))
+
+# CPU inference profile, ignored on GPU where the model always runs in bfloat16.
+# CPU_DTYPE is auto (bfloat16 if the CPU has native bfloat16 instructions, float32
+# otherwise), float32 or bfloat16. CPU_QUANTIZE=int8 quantizes the linear layers
+# dynamically (on float32 weights). TORCH_THREADS=0 sizes the intra-op pool to the
+# CPUs granted to the container.
+CPU_DTYPE = os.environ.get('CPU_DTYPE', 'auto')
+CPU_QUANTIZE = os.environ.get('CPU_QUANTIZE', 'none')
+TORCH_THREADS = int(os.environ.get('TORCH_THREADS', 0))
+TORCH_INTEROP_THREADS = int(os.environ.get('TORCH_INTEROP_THREADS', 1))
+
+# Time a few forward passes at startup and log the pages/sec and queries/sec of the profile
+STARTUP_BENCHMARK = os.environ.get('STARTUP_BENCHMARK', 'true').lower() == 'true'
+
 
 # Define input types
 class PredictionMode(str, Enum):
@@ -28,31 +104,173 @@ class PredictionInput(BaseModel):
 
 
 class Predictor:
-  # Initialize the ColQwen2 model and processor, called at application startup
+  # Initialize the ColQwen2 model and processor, called at application startup.
+  # The time spent in each step is kept in startup_timings (seconds).
   def setup(self):
+    self.load_model()
+    self.start_workers()
+
+  # Load the weights and the processor. Nothing here starts a thread, a process or a
+  # connection, so the loaded model can be shared with forked workers (see app.serve).
+  # With for_fork, the dtype conversion and quantization run on a single intra-op thread:
+  # the OpenMP thread pool of torch does not survive a fork, a worker forked after a
+  # multi-threaded kernel would hang at its first parallel region. Each worker sets its
+  # own thread count in start_workers.
+  # Input: for_fork (bool, the model is loaded before forking the workers)
+  def load_model(self, for_fork=False):
     try:
       logging.info('🚀 Initializing the model...')
       self.model_name = 'vidore/colqwen2-v0.1'
       logging.info(f'📦 Loading model from: {self.model_name}')
+      self.startup_timings = {}
 
       # Determine the device. If a GPU is available, use it, otherwise CPU.
       device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
       logging.info(f'💻 Using device: {device}')
-
+      self.inference_profile = self.select_inference_profile(device)
+      logging.info(f'⚙️ Inference profile: {self.inference_profile}')
+      if self.inference_profile['threads']:
+        torch.set_num_threads(1 if for_fork else self.inference_profile['threads'])
+
+      start = time.perf_counter()
+      # Safetensors weights are memory-mapped and copied once into the model,
+      # without first materializing randomly initialized weights
       self.model = ColQwen2.from_pretrained(
         self.model_name,
-        torch_dtype=torch.bfloat16,
-        device_map='auto',
+        torch_dtype=self.inference_profile['dtype'],
+        device_map='auto' if device != 'cpu' else 'cpu',
+        low_cpu_mem_usage=True,
+        use_safetensors=True,
       ).eval()
+      if self.inference_profile['quantize'] == 'int8':
+        logging.info('🔧 Quantizing linear layers to int8...')
+        torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+      self.startup_timings['weights'] = round(time.perf_counter() - start, 3)
 
       logging.info('🔧 Loading processor...')
+      start = time.perf_counter()
       self.processor = ColQwen2Processor.from_pretrained(self.model_name)
+      self.startup_timings['processor'] = round(time.perf_counter() - start, 3)
+
+      # Forward passes of query batches overtake those of document pages
+      self.model_lock = PriorityLock()
+      logging.info('✅ Model loaded successfully!')
+    except Exception as e:
+      logging.error(f'❌ Error during model setup: {e}')
+      raise
+
+  # Warm up the loaded model and start the pipeline workers, caches and connections
+  # of this process (once per worker when the model is loaded before forking)
+  def start_workers(self):
+    try:
+      if self.inference_profile['threads']:
+        # Applied in this process, so that a forked worker starts its own intra-op thread pool
+        torch.set_num_threads(self.inference_profile['threads'])
+
+      start = time.perf_counter()
+      self.warmup_model()
+      self.startup_timings['warmup'] = round(time.perf_counter() - start, 3)
+
+      if STARTUP_BENCHMARK:
+        start = time.perf_counter()
+        self.benchmark_inference()
+        self.startup_timings['benchmark'] = round(time.perf_counter() - start, 3)
+
+      logging.info(
+        f'🧵 Starting pipeline workers: {RASTER_WORKERS} rasterize, {ENCODE_WORKERS} encode, {TEXT_WORKERS} text'
+      )
+      self.raster_executor = ThreadPoolExecutor(max_workers=RASTER_WORKERS, thread_name_prefix='rasterize')
+      self.encode_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='encode')
+      self.text_executor = self.create_text_executor()
+
+      # Keep-alive connections shared by the document downloads
+      self.http_session = create_session()
+
+      self.query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS)
+      self.page_store = PageEmbeddingStore(PAGE_CACHE_DIR, PAGE_CACHE_MAX_BYTES) if PAGE_CACHE_MAX_BYTES > 0 else None
+      if TOKEN_POOL_FACTOR > 1:
+        logging.info(f'🧩 Pooling page patch vectors by a factor of {TOKEN_POOL_FACTOR}')
 
       logging.info('✅ Setup completed successfully!')
     except Exception as e:
       logging.error(f'❌ Error during model setup: {e}')
       raise
 
+  # Choose the dtype, quantization and threads of the model and apply the inter-op thread setting
+  # Input: device (str)
+  # Output: Dict[str, Any] (name, dtype, quantize, threads, interop_threads)
+  def select_inference_profile(self, device):
+    if device != 'cpu':
+      return {
+        'name': 'gpu-bfloat16',
+        'dtype': torch.bfloat16,
+        'quantize': 'none',
+        'threads': None,
+        'interop_threads': None,
+      }
+
+    if CPU_DTYPE not in ('auto', 'float32', 'bfloat16'):
+      raise ValueError(f'Unknown CPU_DTYPE: {CPU_DTYPE}, expected auto, float32 or bfloat16')
+    if CPU_QUANTIZE not in ('none', 'int8'):
+      raise ValueError(f'Unknown CPU_QUANTIZE: {CPU_QUANTIZE}, expected none or int8')
+
+    if CPU_QUANTIZE == 'int8':
+      # Dynamic quantization works on float32 linear layers
+      dtype_name = 'float32'
+    elif CPU_DTYPE == 'auto':
+      dtype_name = 'bfloat16' if cpu_supports_bfloat16() else 'float32'
+    else:
+      dtype_name = CPU_DTYPE
+
+    threads = TORCH_THREADS or container_cpu_count()
+    try:
+      torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+    except RuntimeError as e:
+      # Only allowed before the first inter-op parallel work of the process
+      logging.warning(f'⚠️ Could not set inter-op threads: {e}')
+
+    name = f'cpu-{dtype_name}' + ('-int8' if CPU_QUANTIZE == 'int8' else '')
+    return {
+      'name': name,
+      'dtype': getattr(torch, dtype_name),
+      'quantize': CPU_QUANTIZE,
+      'threads': threads,
+      'interop_threads': torch.get_num_interop_threads(),
+    }
+
+  # Blank page of the size fed to the model (A4 portrait), for warmup and benchmark
+  # Output: PIL.Image
+  def blank_page(self):
+    return Image.new('RGB', (int(MODEL_IMAGE_HEIGHT / 1.414), MODEL_IMAGE_HEIGHT), 'white')
+
+  # Run one page and one query through the model, so that the lazy initialization
+  # of the kernels for both input shapes is paid at startup, not by the first request
+  def warmup_model(self):
+    logging.info('🔥 Warming up the model...')
+    self.embed_images([self.blank_page()])
+    self.embed_query_batch(['warmup query'])
+
+  # Time the warmed up model on blank pages and a batch of short queries
+  # Output: Dict[str, float] (pages_per_second, queries_per_second)
+  def benchmark_inference(self):
+    logging.info('⏱️ Benchmarking the inference profile...')
+    pages = [self.blank_page()] * 2
+    queries = [f'benchmark query number {i}' for i in range(8)]
+
+    start = time.perf_counter()
+    self.embed_images(pages)
+    pages_per_second = len(pages) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    self.embed_query_batch(queries)
+    queries_per_second = len(queries) / (time.perf_counter() - start)
+
+    logging.info(
+      f'⏱️ Inference profile {self.inference_profile["name"]}: '
+      f'{pages_per_second:.2f} pages/sec, {queries_per_second:.1f} queries/sec'
+    )
+    return {'pages_per_second': pages_per_second, 'queries_per_second': queries_per_second}
+
   def setup_01(self):
     try:
       logging.info('🚀 Initializing the model...')
@@ -71,84 +289,94 @@ class Predictor:
       logging.error(f'❌ Error during model setup: {e}')
       raise
 
-  # Download the PDF from the provided URL
-  # Input: url (str)
-  # Output: BytesIO (PDF content)
-  def download_pdf(self, url):
+  # Download the PDF from the provided URL through the pooled session, streamed to its
+  # document file (see app.utils.download)
+  # Input: url (str), document_file (binary file object, empty)
+  # Output: int (size in bytes)
+  def download_pdf(self, url, document_file):
     try:
       logging.info(f'📥 Downloading PDF from: {url}')
-      response = requests.get(url, timeout=10)  # 10 seconds timeout
-      if response.status_code == 200:
-        logging.info('✅ Download completed successfully!')
-        return BytesIO(response.content)
-      else:
-        error_msg = f'❌ Download failed with status code: {response.status_code}'
-        logging.error(error_msg)
-        raise Exception(error_msg)
-    except requests.exceptions.Timeout:
-      error_msg = '❌ Download failed: timeout'
-      logging.error(error_msg)
-      raise Exception(error_msg)
+      size = download_to_file(self.http_session, url, document_file)
+      logging.info('✅ Download completed successfully!')
+      return size
     except Exception as e:
       logging.error(f'❌ Error during PDF download: {e}')
       raise
 
-  # Extract content (text and images) from the PDF
-  # Input: pdf_file (BytesIO)
-  # Output: tuple (images, page_texts)
-  def get_pdf_content(self, pdf_file):
-    try:
-      logging.info('🔍 Starting PDF content extraction...')
-
-      # Read the entire PDF into memory once
-      pdf_data = pdf_file.getvalue()
-
-      temp_file = '/tmp/temp.pdf'
-      logging.info('💾 Saving temporary PDF...')
-      with open(temp_file, 'wb') as f:
-        f.write(pdf_data)
-
-      logging.info('📄 Extracting text...')
-      reader = PdfReader(temp_file)
-      page_texts = []
-      for page_number in range(len(reader.pages)):
-        logging.info(f'  📃 Processing page {page_number + 1}/{len(reader.pages)}')
-        page = reader.pages[page_number]
-        text = page.extract_text()
-        page_texts.append(text)
-
-      logging.info('🖼️ Extracting images...')
-      # Now using pdf_data directly for convert_from_bytes,
-      # avoiding re-reading from pdf_file which might have been consumed already.
-      images = convert_from_bytes(pdf_data)
-      logging.info(f'📊 Extracted {len(images)} images and {len(page_texts)} texts')
-      return images, page_texts
-    except Exception as e:
-      logging.error(f'❌ Error during PDF content extraction: {e}')
-      raise
-
-  def get_pdf_content_old(self, pdf_file):
+  # Create the process pool used for text extraction. Spawned rather than forked,
+  # so the workers do not inherit the model and the threads of this process.
+  # Output: ProcessPoolExecutor
+  def create_text_executor(self):
+    return ProcessPoolExecutor(max_workers=TEXT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+  # Start extracting the text of every page in the text pool, one task per window of pages.
+  # Only the path of the document file and the page indexes are sent, each worker parses
+  # the document once and reuses it for the following windows. The worker extracting the
+  # last window closes the document, the others when their next window is of another one.
+  # Input: pdf_path (str), page_count (int),
+  #        stats (PipelineStats, optional), first_page_index (int, pages before it are left out)
+  # Output: List[tuple (List[int] page indexes, Future)]
+  def submit_pdf_texts(self, pdf_path, page_count, stats=None, first_page_index=0):
+    text_chunks = []
+    for window_start in range(first_page_index, page_count, PAGE_WINDOW_SIZE):
+      page_indexes = list(range(window_start, min(window_start + PAGE_WINDOW_SIZE, page_count)))
+      task = (extract_page_texts, pdf_path, page_indexes, TEXT_PAGE_TIMEOUT_SECONDS, page_indexes[-1] + 1 == page_count)
+      try:
+        future = self.text_executor.submit(*task)
+      except BrokenProcessPool:
+        logging.warning('⚠️ Text extraction pool is broken, restarting it')
+        self.text_executor = self.create_text_executor()
+        future = self.text_executor.submit(*task)
+      if stats is not None:
+        future.add_done_callback(partial(self.record_text_chunk, stats, len(page_indexes)))
+      text_chunks.append((page_indexes, future))
+    return text_chunks
+
+  # Record the extraction time of a window of texts, unless it was cancelled or failed
+  # Input: stats (PipelineStats), pages (int), future (Future of extract_page_texts)
+  def record_text_chunk(self, stats, pages, future):
+    if not future.cancelled() and future.exception() is None:
+      stats.record('text', future.result()[1], pages)
+
+  # Wait for the texts started by submit_pdf_texts, pages whose worker failed get an empty text
+  # Input: text_chunks (from submit_pdf_texts)
+  # Output: List[str] (one text per page)
+  def collect_pdf_texts(self, text_chunks):
+    page_texts = []
+    for page_indexes, future in text_chunks:
+      page_texts.extend(self.collect_text_chunk(page_indexes, future))
+    return page_texts
+
+  # Wait for one chunk of texts started by submit_pdf_texts
+  # Input: page_indexes (List[int]), future (Future)
+  # Output: List[str] (one text per page of the chunk, empty if the worker failed)
+  def collect_text_chunk(self, page_indexes, future):
     try:
-      logging.info('🔍 Starting PDF content extraction...')
-      temp_file = 'temp.pdf'
-      logging.info('💾 Saving temporary PDF...')
-      with open(temp_file, 'wb') as f:
-        f.write(pdf_file.read())
-      logging.info('📄 Extracting text...')
-      reader = PdfReader(temp_file)
-      page_texts = []
-      for page_number in range(len(reader.pages)):
-        logging.info(f'  📃 Processing page {page_number + 1}/{len(reader.pages)}')
-        page = reader.pages[page_number]
-        text = page.extract_text()
-        page_texts.append(text)
-      logging.info('🖼️ Extracting images...')
-      images = convert_from_bytes(pdf_file.getvalue())
-      logging.info(f'📊 Extracted {len(images)} images and {len(page_texts)} texts')
-      return images, page_texts
+      chunk_texts, _ = future.result()
+      return chunk_texts
     except Exception as e:
-      logging.error(f'❌ Error during PDF content extraction: {e}')
-      raise
+      logging.error(f'❌ Error during text extraction of pages {page_indexes[0] + 1}-{page_indexes[-1] + 1}: {e}')
+      return [''] * len(page_indexes)
+
+  # Count the pages of a PDF file, only the page tree is read
+  # Input: pdf_path (str)
+  # Output: int
+  def get_pdf_page_count(self, pdf_path):
+    with open(pdf_path, 'rb') as pdf_file:
+      return len(PdfReader(pdf_file).pages)
+
+  # Resize the image while maintaining the aspect ratio
+  # Input: image (PIL.Image), max_height (int)
+  # Output: PIL.Image (resized)
+  def resize_image(self, image, max_height=512):
+    width, height = image.size
+    if height > max_height:
+      ratio = max_height / height
+      new_width = int(width * ratio)
+      new_height = int(height * ratio)
+      logging.info(f'🔄 Resizing image from {width}x{height} to {new_width}x{new_height}')
+      return image.resize((new_width, new_height))
+    return image
 
   # Convert the image to base64 format
   # Input: image (PIL.Image)
@@ -163,6 +391,483 @@ class Predictor:
       logging.error(f'❌ Error during image to base64 conversion: {e}')
       raise
 
+  # Rasterize a window of consecutive pages and prepare the model inputs (pipeline stage).
+  # Pages are rendered directly at thumbnail size instead of at the default 200 DPI, from the
+  # document file: poppler reads the pages of the window without the PDF being copied again.
+  # Input: pdf_path (str), first_page_index (int), last_page_index (int, exclusive), stats (PipelineStats)
+  # Output: tuple (first_page_index, List[PIL.Image] thumbnails, List[PIL.Image] model size, List[str] page keys,
+  #         List[tuple] (ink ratio, difference hash) of each page)
+  def rasterize_window(self, pdf_path, first_page_index, last_page_index, stats):
+    with stats.stage('rasterize', pages=last_page_index - first_page_index):
+      logging.info(f'🖼️ Rasterizing pages {first_page_index + 1}-{last_page_index}')
+      # pdf2image page numbers are 1-based and inclusive
+      thumbnails = convert_from_path(
+        pdf_path,
+        first_page=first_page_index + 1,
+        last_page=last_page_index,
+        size=(None, THUMBNAIL_HEIGHT),
+      )
+      model_images = [self.resize_image(img, max_height=MODEL_IMAGE_HEIGHT) for img in thumbnails]
+      # Content address of each page in the embedding store, hashed here to keep it off the model thread
+      page_keys = [PageEmbeddingStore.page_key(self.model_name, img) for img in model_images]
+      # Blank and duplicate page detection, computed here for the same reason
+      signatures = [(ink_ratio(img), difference_hash(img)) for img in model_images]
+    return first_page_index, thumbnails, model_images, page_keys, signatures
+
+  # Encode a window of page thumbnails to base64 JPEG (pipeline stage)
+  # Input: images (List[PIL.Image]), stats (PipelineStats)
+  # Output: List[str] (images in base64)
+  def encode_window(self, images, stats):
+    with stats.stage('encode', pages=len(images)):
+      return [self.get_base64_image(img) for img in images]
+
+  # Run the model on a batch of page images
+  # Input: images (List[PIL.Image])
+  # Output: torch.Tensor (CPU embeddings, shape [pages, vectors, dim])
+  def embed_images(self, images):
+    with timed_stage('document', 'preprocess', len(images)):
+      batch_inputs = self.processor.process_images(images)
+    wait_start = time.perf_counter()
+    with self.model_lock.hold(), torch.no_grad():
+      observe_stage('document', 'model_wait', time.perf_counter() - wait_start)
+      with timed_stage('document', 'forward', len(images)):
+        return self.model(**batch_inputs.to(self.model.device)).to('cpu')
+
+  # Grid of visual tokens the processor gives a page, from the size it resizes the page to
+  # Input: image (PIL.Image)
+  # Output: tuple (int rows, int columns)
+  def page_token_grid(self, image):
+    processor = self.processor
+    height, width = processor.smart_resize_helper(
+      width=image.size[0],
+      height=image.size[1],
+      factor=processor.factor,
+      max_ratio=processor.max_ratio,
+      min_pixels=processor.min_pixels,
+      max_pixels=processor.max_pixels,
+    )
+    return height // processor.factor, width // processor.factor
+
+  # Embed a window of pages with the model (pipeline stage, runs on the calling thread).
+  # Pages already in the embedding store are read back instead of recomputed.
+  # Input: images (List[PIL.Image]), page_keys (List[str]), stats (PipelineStats)
+  # Output: List[torch.Tensor] (one CPU embedding per page)
+  def embed_window(self, images, page_keys, stats):
+    page_embeddings = [None] * len(images)
+
+    if self.page_store is not None:
+      start = time.perf_counter()
+      for index, page_key in enumerate(page_keys):
+        stored = self.page_store.get(page_key)
+        if stored is not None:
+          page_embeddings[index] = torch.from_numpy(np.array(stored))
+      cached_pages = sum(embedding is not None for embedding in page_embeddings)
+      stats.record('page_cache', time.perf_counter() - start, pages=cached_pages)
+
+    missing = [index for index, embedding in enumerate(page_embeddings) if embedding is None]
+    # Pages are batched with pages of the same size only (a portrait page is never padded
+    # to a landscape slide), as many per batch as the token budget allows; embeddings are
+    # put back at the index of their page
+    grids = [self.page_token_grid(images[index]) for index in missing]
+    with stats.stage('embed', pages=len(missing)):
+      for batch in bucket_batches(grids, PAGE_BATCH_TOKEN_BUDGET):
+        sub_batch = [missing[position] for position in batch]
+        batch_embeddings = self.embed_images([images[index] for index in sub_batch])
+        for index, embedding in zip(sub_batch, torch.unbind(batch_embeddings)):
+          page_embeddings[index] = embedding
+          if self.page_store is not None:
+            # Written from the encode pool so disk I/O stays off the model thread
+            future = self.encode_executor.submit(self.page_store.put, page_keys[index], embedding.float().numpy())
+            future.add_done_callback(self.log_page_store_failure)
+    return page_embeddings
+
+  # Report a page that could not be written to the embedding store (its embedding is still returned)
+  # Input: future (Future of PageEmbeddingStore.put)
+  def log_page_store_failure(self, future):
+    if not future.cancelled() and future.exception() is not None:
+      logging.warning(f'⚠️ Page embedding could not be stored: {future.exception()}')
+
+  # Decide which pages of a window run through the model: blank pages are dropped and a
+  # duplicate of a page already embedded in the same document reuses its embedding. The
+  # image signatures only shortlist pages, a page with text is never dropped and a
+  # duplicate must have the same model image or the same text as its original.
+  # Input: document (Dict[str, Any] from load_document), first_page_index (int),
+  #        signatures (List[tuple] from rasterize_window), page_keys (List[str] from rasterize_window),
+  #        page_texts (List[str], extracted text of each page), stats (PipelineStats)
+  # Output: List[Optional[int]] (per page: None if blank, else the index of the page whose
+  #         embedding it gets, which is its own index when the page is embedded)
+  def filter_window(self, document, first_page_index, signatures, page_keys, page_texts, stats):
+    sources = []
+    with stats.stage('filter', pages=len(signatures)):
+      for offset, (page_ink_ratio, page_hash) in enumerate(signatures):
+        page_index = first_page_index + offset
+        page_key, page_text = page_keys[offset], page_texts[offset].strip()
+        if page_ink_ratio < BLANK_PAGE_INK_RATIO and not page_text:
+          document['pages_skipped'] += 1
+          sources.append(None)
+          continue
+        candidates = [
+          (embedded_hash, embedded_page_index)
+          for embedded_hash, embedded_page_index, embedded_key, embedded_text in document['page_hashes']
+          if embedded_key == page_key or (page_text and embedded_text == page_text)
+        ]
+        source_page_index = find_duplicate(page_hash, candidates)
+        if source_page_index is None:
+          if DUPLICATE_PAGE_MAX_DISTANCE >= 0:
+            document['page_hashes'].append((page_hash, page_index, page_key, page_text))
+          source_page_index = page_index
+        else:
+          document['pages_reused'] += 1
+        sources.append(source_page_index)
+    return sources
+
+  # Pool the patch vectors of a window of embedded pages (pipeline stage).
+  # Pages are stored unpooled in the embedding store, so the factor can change freely.
+  # Input: embeddings (List[torch.Tensor]), stats (PipelineStats)
+  # Output: List[torch.Tensor] (pooled embeddings, unchanged when pooling is disabled)
+  def pool_window(self, embeddings, stats):
+    if TOKEN_POOL_FACTOR <= 1:
+      return embeddings
+    with stats.stage('pool', pages=len(embeddings)):
+      return [pool_embedding(embedding, TOKEN_POOL_FACTOR) for embedding in embeddings]
+
+  # Write a PDF to its document file (downloaded, unless its bytes came inline with the
+  # request) and start what the pipeline needs besides rasterization. With a page range,
+  # only the pages of the range are rasterized, embedded and returned (the document is a
+  # shard of a larger one). The document file is deleted by release_document.
+  # Input: pdf_url (str, may be None when pdf_content is given), stats (PipelineStats), pdf_content (bytes or None),
+  #        page_range (tuple (int first page index, Optional[int] last page index, exclusive), default whole PDF)
+  # Output: Dict[str, Any] (url, title, path, page_count, first_page_index, last_page_index, text_chunks)
+  def load_document(self, pdf_url, stats, pdf_content=None, page_range=None):
+    logging.info(f'🔗 PDF URL: {pdf_url}')
+    document_file = create_document_file()
+    try:
+      with document_file:
+        if pdf_content is not None:
+          logging.info(f'📄 PDF received inline ({len(pdf_content)} bytes), skipping the download')
+          document_file.write(pdf_content)
+        else:
+          with stats.stage('download'):
+            self.download_pdf(pdf_url, document_file)
+            logging.info('📄 PDF downloaded successfully')
+      pdf_path = document_file.name
+      page_count = self.get_pdf_page_count(pdf_path)
+      first_page_index, last_page_index = page_range or (0, None)
+      # A range past the end of the document is cut down to its last page
+      last_page_index = page_count if last_page_index is None else min(last_page_index, page_count)
+      first_page_index = min(first_page_index, last_page_index)
+      logging.info(
+        f'📄 PDF has {page_count} pages, extracting text of pages {first_page_index + 1}-{last_page_index}'
+        ' in the background'
+      )
+      # Collected once the pages are embedded, so text extraction overlaps rasterization
+      text_chunks = self.submit_pdf_texts(pdf_path, last_page_index, stats, first_page_index)
+    except BaseException:
+      os.unlink(document_file.name)
+      raise
+    return {
+      'url': pdf_url,
+      'title': pdf_url.split('/')[-1] if pdf_url else '',
+      'path': pdf_path,
+      'page_count': page_count,
+      'first_page_index': first_page_index,
+      'last_page_index': last_page_index,
+      'text_chunks': text_chunks,
+      # Filled by the page pipeline: hashes and embeddings of the embedded pages, reused by their duplicates
+      'page_hashes': [],
+      'page_embeddings': {},
+      'pages_skipped': 0,
+      'pages_reused': 0,
+    }
+
+  # Load the documents of a request, then release them all once the request is done,
+  # whether it completed, failed or (for a stream) was closed early
+  # Input: pdf_urls (List[str]), pdf_contents (List[bytes or None]), page_ranges (List[tuple or None]),
+  #        stats (PipelineStats)
+  # Output: context manager of List[Dict[str, Any]] (from load_document)
+  @contextmanager
+  def open_documents(self, pdf_urls, pdf_contents, page_ranges, stats):
+    documents = []
+    try:
+      for pdf_url, pdf_content, page_range in zip(pdf_urls, pdf_contents, page_ranges):
+        documents.append(self.load_document(pdf_url, stats, pdf_content, page_range))
+      yield documents
+    finally:
+      for document in documents:
+        self.release_document(document)
+
+  # Stop the text extraction still pending for a document and delete its document file
+  # Input: document (Dict[str, Any] from load_document)
+  def release_document(self, document):
+    for _, future in document['text_chunks']:
+      future.cancel()
+    try:
+      os.unlink(document['path'])
+    except FileNotFoundError:
+      pass
+
+  # Run the document pipeline: windows are rasterized ahead of the model in the
+  # raster pool, embedded on this thread, then JPEG-encoded and pooled in the
+  # encode pool while the model moves on to the next window. At most
+  # PIPELINE_DEPTH windows wait for the model, so memory stays bounded by the
+  # window size. Several documents share the same pipeline, one after the other.
+  # With the page filters on (see app.utils.page_filter), blank pages are left out and
+  # duplicate pages get the embedding of their original.
+  # Input: documents (List[Dict[str, Any]] from load_document), stats (PipelineStats)
+  # Output: generator of tuple (document_index, page_index, image_base64, embedding), in page order
+  def iter_document_pages(self, documents, stats):
+    windows = iter(
+      [
+        (document_index, first_page_index, min(first_page_index + PAGE_WINDOW_SIZE, document['last_page_index']))
+        for document_index, document in enumerate(documents)
+        for first_page_index in range(document['first_page_index'], document['last_page_index'], PAGE_WINDOW_SIZE)
+      ]
+    )
+    rasterized = deque()
+
+    def schedule_next_window():
+      window = next(windows, None)
+      if window is not None:
+        document_index, first_page_index, last_page_index = window
+        future = self.raster_executor.submit(
+          self.rasterize_window, documents[document_index]['path'], first_page_index, last_page_index, stats
+        )
+        rasterized.append((document_index, future))
+
+    def collect_window(document_index, first_page_index, sources, encoded, pooled):
+      page_embeddings = documents[document_index]['page_embeddings']
+      images_base64 = iter(encoded.result())
+      embeddings = iter(pooled.result())
+      for offset, source_page_index in enumerate(sources):
+        if source_page_index is None:
+          continue
+        page_index = first_page_index + offset
+        if source_page_index == page_index:
+          embedding = next(embeddings)
+          if DUPLICATE_PAGE_MAX_DISTANCE >= 0:
+            page_embeddings[page_index] = embedding
+        else:
+          # The original always comes first in page order, so it is already collected
+          embedding = page_embeddings[source_page_index]
+        yield document_index, page_index, next(images_base64), embedding
+
+    for _ in range(PIPELINE_DEPTH):
+      schedule_next_window()
+
+    pending = None
+    try:
+      while rasterized:
+        document_index, future = rasterized.popleft()
+        first_page_index, thumbnails, model_images, page_keys, signatures = future.result()
+        schedule_next_window()
+
+        document = documents[document_index]
+        if PAGE_FILTERS_ENABLED:
+          # Text chunks cover the same windows of pages as the pipeline
+          chunk_index = (first_page_index - document['first_page_index']) // PAGE_WINDOW_SIZE
+          page_texts = self.collect_text_chunk(*document['text_chunks'][chunk_index])
+          sources = self.filter_window(document, first_page_index, signatures, page_keys, page_texts, stats)
+        else:
+          sources = list(range(first_page_index, first_page_index + len(model_images)))
+        kept = [offset for offset, source_page_index in enumerate(sources) if source_page_index is not None]
+        embedded = [offset for offset in kept if sources[offset] == first_page_index + offset]
+
+        encoded = self.encode_executor.submit(self.encode_window, [thumbnails[offset] for offset in kept], stats)
+        del thumbnails
+        logging.info(
+          f'🧠 Embedding {len(embedded)} of pages {first_page_index + 1}-{first_page_index + len(model_images)}'
+          f'/{document["page_count"]} ({len(sources) - len(kept)} blank, {len(kept) - len(embedded)} duplicates)'
+        )
+        embeddings = self.embed_window(
+          [model_images[offset] for offset in embedded], [page_keys[offset] for offset in embedded], stats
+        )
+        del model_images
+        pooled = self.encode_executor.submit(self.pool_window, embeddings, stats)
+
+        # Hand out the previous window while this one is still being encoded
+        if pending is not None:
+          yield from collect_window(*pending)
+        pending = (document_index, first_page_index, sources, encoded, pooled)
+
+      if pending is not None:
+        yield from collect_window(*pending)
+    finally:
+      for _, future in rasterized:
+        future.cancel()
+
+  # Embed several PDFs through one shared page pipeline
+  # Input: pdf_urls (List[str]), embedding_formats (List[str], one per URL, default json),
+  #        pdf_contents (List[bytes or None], inline PDF of each URL, default None: download the URL),
+  #        page_ranges (List[tuple or None], pages of each URL to embed, default None: every page)
+  # Output: List[List[Dict[str, Any]]] (one document prediction per URL, same format as predict)
+  def predict_documents(self, pdf_urls, embedding_formats=None, pdf_contents=None, page_ranges=None):
+    embedding_formats = embedding_formats or ['json'] * len(pdf_urls)
+    pdf_contents = pdf_contents or [None] * len(pdf_urls)
+    page_ranges = page_ranges or [None] * len(pdf_urls)
+    stats = PipelineStats()
+    with self.open_documents(pdf_urls, pdf_contents, page_ranges, stats) as documents:
+      page_indexes = [[] for _ in documents]
+      page_images = [[] for _ in documents]
+      page_embeddings = [[] for _ in documents]
+      for document_index, page_index, image_base64, embedding in self.iter_document_pages(documents, stats):
+        page_indexes[document_index].append(page_index)
+        page_images[document_index].append(image_base64)
+        page_embeddings[document_index].append(embedding)
+      # Texts of the pages left once the blank ones are dropped
+      page_texts = []
+      for document, indexes in zip(documents, page_indexes):
+        texts = self.collect_pdf_texts(document['text_chunks'])
+        page_texts.append([texts[page_index - document['first_page_index']] for page_index in indexes])
+
+      page_count = sum(document['last_page_index'] - document['first_page_index'] for document in documents)
+      pipeline_stats = stats.report(page_count)
+      logging.info(f'📊 Pipeline throughput: {pipeline_stats}')
+
+      predictions = []
+      for document, indexes, texts, images, embeddings, embedding_format in zip(
+        documents, page_indexes, page_texts, page_images, page_embeddings, embedding_formats
+      ):
+        with timed_stage('document', 'serialize', len(embeddings)):
+          encoded_embeddings = [encode_embedding(e, embedding_format) for e in embeddings]
+        # cooking the final result
+        pdf_data = {
+          'url': document['url'],
+          'title': document['title'],
+          'first_page_index': document['first_page_index'],
+          'last_page_index': document['last_page_index'],
+          'page_indexes': indexes,
+          'images': images,
+          'texts': texts,
+          'embeddings': encoded_embeddings,
+          'pages_skipped': document['pages_skipped'],
+          'pages_reused': document['pages_reused'],
+          'stats': pipeline_stats,
+        }
+        predictions.append([pdf_data])
+      return predictions
+
+  # Embed several PDFs through one shared page pipeline, handing out every page as
+  # soon as it is embedded instead of once the last page is done
+  # Input: pdf_urls (List[str]), embedding_formats (List[str], one per URL, default json),
+  #        pdf_contents (List[bytes or None], inline PDF of each URL, default None: download the URL),
+  #        page_ranges (List[tuple or None], pages of each URL to embed, default None: every page)
+  # Output: generator of Dict[str, Any] (one 'page' record per page, in order, then one 'summary' record)
+  def stream_documents(self, pdf_urls, embedding_formats=None, pdf_contents=None, page_ranges=None):
+    embedding_formats = embedding_formats or ['json'] * len(pdf_urls)
+    pdf_contents = pdf_contents or [None] * len(pdf_urls)
+    page_ranges = page_ranges or [None] * len(pdf_urls)
+    stats = PipelineStats()
+    with self.open_documents(pdf_urls, pdf_contents, page_ranges, stats) as documents:
+      chunk_texts = {}
+      for document_index, page_index, image_base64, embedding in self.iter_document_pages(documents, stats):
+        document = documents[document_index]
+        # Text chunks cover the same windows of pages as the pipeline
+        chunk_index, chunk_offset = divmod(page_index - document['first_page_index'], PAGE_WINDOW_SIZE)
+        chunk_key = (document_index, chunk_index)
+        if chunk_key not in chunk_texts:
+          chunk_texts[chunk_key] = self.collect_text_chunk(*document['text_chunks'][chunk_index])
+        with timed_stage('document', 'serialize', 1):
+          encoded_embedding = encode_embedding(embedding, embedding_formats[document_index])
+        yield {
+          'type': 'page',
+          'document_index': document_index,
+          'url': document['url'],
+          'page_index': page_index,
+          'page_count': document['page_count'],
+          'text': chunk_texts[chunk_key][chunk_offset],
+          'image': image_base64,
+          'embedding': encoded_embedding,
+        }
+
+      page_count = sum(document['last_page_index'] - document['first_page_index'] for document in documents)
+      pipeline_stats = stats.report(page_count)
+      logging.info(f'📊 Pipeline throughput: {pipeline_stats}')
+      yield {
+        'type': 'summary',
+        'documents': [
+          {
+            'url': document['url'],
+            'title': document['title'],
+            'page_count': document['page_count'],
+            'first_page_index': document['first_page_index'],
+            'last_page_index': document['last_page_index'],
+            'pages_skipped': document['pages_skipped'],
+            'pages_reused': document['pages_reused'],
+          }
+          for document in documents
+        ],
+        'stats': pipeline_stats,
+      }
+
+  # Normalize a query so that trivially different spellings share an embedding
+  # Input: query_text (str)
+  # Output: str (NFKC-normalized text with collapsed whitespace)
+  def normalize_query(self, query_text):
+    return ' '.join(unicodedata.normalize('NFKC', query_text).split())
+
+  # Look up a query embedding in the cache, without touching the model
+  # Input: query_text (str), embedding_format (str)
+  # Output: Optional[Dict[str, Any]] (same format as predict in query mode, None on a cache miss)
+  def lookup_query(self, query_text, embedding_format='json'):
+    embedding = self.query_cache.get((self.model_name, self.normalize_query(query_text)))
+    if embedding is None:
+      return None
+    return {
+      'query': query_text,
+      'embeddings': [encode_embedding(embedding, embedding_format)],
+    }
+
+  # Run the model on a batch of queries with a single padded forward pass
+  # Input: query_texts (List[str])
+  # Output: List[torch.Tensor] (one CPU embedding per query, padding tokens removed)
+  def embed_query_batch(self, query_texts):
+    with timed_stage('query', 'preprocess', len(query_texts)):
+      batch_query = self.processor.process_queries(query_texts)
+    # Queries are left-padded to the longest one, keep only the real tokens of each query
+    attention_mask = batch_query['attention_mask'].bool()
+
+    wait_start = time.perf_counter()
+    with self.model_lock.hold(urgent=True), torch.no_grad():
+      observe_stage('query', 'model_wait', time.perf_counter() - wait_start)
+      with timed_stage('query', 'forward', len(query_texts)):
+        batch_query = {k: v.to(self.model.device) for k, v in batch_query.items()}
+        embeddings_query = self.model(**batch_query).cpu()
+
+    return [embedding[mask] for embedding, mask in zip(embeddings_query, attention_mask)]
+
+  # Embed a batch of queries, cached queries are not recomputed
+  # Input: query_texts (List[str])
+  # Output: List[torch.Tensor] (one CPU embedding per query, padding tokens removed)
+  def embed_queries(self, query_texts):
+    keys = [(self.model_name, self.normalize_query(query_text)) for query_text in query_texts]
+    # Hits and misses are counted by lookup_query, in front of the batcher
+    embeddings = [self.query_cache.get(key, record_stats=False) for key in keys]
+    missing_keys = list(dict.fromkeys(key for key, embedding in zip(keys, embeddings) if embedding is None))
+    if not missing_keys:
+      return embeddings
+
+    computed = dict(zip(missing_keys, self.embed_query_batch([text for _, text in missing_keys])))
+    for key, embedding in computed.items():
+      self.query_cache.put(key, embedding)
+
+    return [embedding if embedding is not None else computed[key] for key, embedding in zip(keys, embeddings)]
+
+  # Embed a batch of queries and format one query result per input
+  # Input: query_texts (List[str]), embedding_formats (List[str], one per query, default json)
+  # Output: List[Dict[str, Any]] (same format as predict in query mode)
+  def predict_queries(self, query_texts, embedding_formats=None):
+    embedding_formats = embedding_formats or ['json'] * len(query_texts)
+    logging.info(f'🧠 Generating embeddings for {len(query_texts)} queries...')
+    embeddings = self.embed_queries(query_texts)
+    with timed_stage('query', 'serialize', len(query_texts)):
+      return [
+        {
+          'query': query_text,
+          'embeddings': [encode_embedding(embedding, embedding_format)],
+        }
+        for query_text, embedding, embedding_format in zip(query_texts, embeddings, embedding_formats)
+      ]
+
   # Perform prediction based on query or document
   # Input: mode (str), pdf_url (str), query_text (str)
   # Output: Union[List[Dict[str, Any]], Dict[str, Any]] (prediction result)
@@ -192,59 +897,12 @@ class Predictor:
       if mode == 'document':
         if pdf_url is None:
           raise ValueError('PDF URL is required in document mode')
-        logging.info(f'🔗 PDF URL: {pdf_url}')
-
-        # Download and process the PDF
-        pdf_file = self.download_pdf(pdf_url)
-        logging.info('📄 PDF downloaded successfully')
-        images, texts = self.get_pdf_content(pdf_file)
-        logging.info(f'📄 Extracted {len(images)} images and {len(texts)} texts from PDF')
-
-        # Resize the image while maintaining the aspect ratio
-        # Input: image (PIL.Image), max_height (int)
-        # Output: PIL.Image (resized)
-        def resize_image(image, max_height=512):
-          width, height = image.size
-          if height > max_height:
-            ratio = max_height / height
-            new_width = int(width * ratio)
-            new_height = int(height * ratio)
-            logging.info(f'🔄 Resizing image from {width}x{height} to {new_width}x{new_height}')
-            return image.resize((new_width, new_height))
-          return image
-
-        batch_size = 2  # or a smaller value to fit within memory limits
-        page_embeddings = []
-        for i in range(0, len(images), batch_size):
-          sub_batch = images[i : i + batch_size]
-          logging.info(f'🔄 Processing image batch {i//batch_size + 1}/{(len(images) + batch_size - 1) // batch_size}')
-
-          # Resize images before processing
-          sub_batch_resized = [resize_image(img, max_height=300) for img in sub_batch]
-          logging.info(f'🔄 Resized {len(sub_batch_resized)} images')
-
-          batch_inputs = self.processor.process_images(sub_batch_resized).to(self.model.device)
-          with torch.no_grad():
-            batch_embeddings = self.model(**batch_inputs)
-            page_embeddings.extend(list(torch.unbind(batch_embeddings.to('cpu'))))  # nuova versione (testing)
-            logging.info(f'🧠 Generated embeddings for batch {i//batch_size + 1}')
-
-        page_embeddings = [e.tolist() for e in page_embeddings]  # nuova versione (testing)
-
-        logging.info(f'🔗 Concatenated all batch embeddings, total elements: {len(page_embeddings)}')
 
-        # cooking the final result
-        pdf_data = {
-          'url': pdf_url,
-          'title': pdf_url.split('/')[-1],
-          'images': [self.get_base64_image(img) for img in images],
-          'texts': texts,
-          'embeddings': page_embeddings,  # .tolist(),
-        }
+        result = self.predict_documents([pdf_url])[0]
 
         logging.info('✨ Document prediction completed successfully!')
         logging.info(f'⏱️ Total time: {time.time() - start_time} seconds')
-        return [pdf_data]
+        return result
 
       elif mode == 'query':
         if query_text is None:
@@ -252,24 +910,7 @@ class Predictor:
         logging.info(f'📝 Query text: {query_text}')
         logging.info('🧠 Generating query embeddings...')
 
-        # Process the query
-        batch_query = self.processor.process_queries([query_text])
-        batch_query = {k: v.to(self.model.device) for k, v in batch_query.items()}
-        logging.info(f'📥 Query inputs moved to device: {self.model.device}')
-
-        with torch.no_grad():
-          # Get query embeddings
-          embeddings_query = self.model(**batch_query)
-          logging.info('🧠 Generated query embeddings')
-
-        # Move embeddings to CPU and convert to list
-        embeddings_query_cpu = embeddings_query.cpu().tolist()
-        logging.info('📤 Query embeddings moved to CPU')
-
-        result = {
-          'query': query_text,
-          'embeddings': embeddings_query_cpu,
-        }
+        result = self.lookup_query(query_text) or self.predict_queries([query_text])[0]
 
         logging.info('✨ Query prediction completed successfully!')
         logging.info(f'⏱️ Total time: {time.time() - start_time} seconds')
@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+# Document jobs run in DOCUMENT_WORKERS dedicated threads. At most
+# DOCUMENT_QUEUE_SIZE documents may be running or waiting, beyond that new
+# requests are turned away with a Retry-After estimated from recent jobs.
+DOCUMENT_WORKERS = int(os.environ.get('DOCUMENT_WORKERS', 1))
+DOCUMENT_QUEUE_SIZE = int(os.environ.get('DOCUMENT_QUEUE_SIZE', 8))
+
+# Streamed records produced ahead of a slow client, the worker waits beyond that
+STREAM_BUFFER_SIZE = int(os.environ.get('STREAM_BUFFER_SIZE', 16))
+
+
+class QueueFullError(Exception):
+  """
+  Raised when a job is refused because an inference queue (query or document) is full.
+  """
+
+  def __init__(self, message, queue, retry_after):
+    super().__init__(message)
+    self.queue = queue
+    self.retry_after = retry_after
+
+
+class PriorityLock:
+  """
+  Mutual exclusion around the forward passes of the model, with two priorities.
+
+  Urgent holders (query batches) overtake normal ones (document pages): while an
+  urgent holder waits, normal holders do not get the lock. A long document thus
+  delays a query by at most one forward pass of a page batch.
+  """
+
+  def __init__(self):
+    self._condition = threading.Condition()
+    self._locked = False
+    self._urgent_waiting = 0
+
+  @contextmanager
+  def hold(self, urgent=False):
+    with self._condition:
+      if urgent:
+        self._urgent_waiting += 1
+      try:
+        while self._locked or (not urgent and self._urgent_waiting):
+          self._condition.wait()
+      finally:
+        if urgent:
+          self._urgent_waiting -= 1
+      self._locked = True
+    try:
+      yield
+    finally:
+      with self._condition:
+        self._locked = False
+        self._condition.notify_all()
+
+
+class DocumentScheduler:
+  """
+  Bounded queue of document jobs in front of a dedicated thread pool.
+
+  Jobs run off the event loop, so health checks and queries are still served
+  while a long document is embedded. Admission is counted in documents: `admit`
+  refuses a job with `QueueFullError` if its documents do not fit in what is
+  left of `max_documents` (a job is always admitted when nothing is pending,
+  however large it is). Every admitted job must then be passed to `run` or
+  `stream`, or given back with `withdraw` if it will never run.
+  """
+
+  def __init__(self, workers=DOCUMENT_WORKERS, max_documents=DOCUMENT_QUEUE_SIZE):
+    self.workers = workers
+    self.max_documents = max_documents
+    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='document')
+    self._lock = threading.Lock()
+
+    self.pending_documents = 0
+    self.admitted = 0
+    self.rejected = 0
+    self.completed = 0
+    self.seconds_per_document = None
+
+  # Reserve room for a job in the queue, or refuse it
+  # Input: document_count (int)
+  def admit(self, document_count):
+    with self._lock:
+      if self.pending_documents and self.pending_documents + document_count > self.max_documents:
+        self.rejected += 1
+        raise QueueFullError(
+          f'Document queue is full: {self.pending_documents}/{self.max_documents} documents pending',
+          'document',
+          self.retry_after(),
+        )
+      self.pending_documents += document_count
+      self.admitted += 1
+
+  # Give back the room of an admitted job that will never run
+  # Input: document_count (int, as admitted)
+  def withdraw(self, document_count):
+    with self._lock:
+      self.pending_documents -= document_count
+      self.admitted -= 1
+
+  # Run an admitted document job in the pool, its room in the queue is released when it ends.
+  # Cancelling the caller drops a job that has not started yet; a job already running
+  # keeps its room until it returns.
+  # Input: document_count (int, as admitted), fn (callable), args (positional arguments of fn)
+  # Output: the result of fn
+  async def run(self, document_count, fn, *args):
+    job = self._executor.submit(self._timed, document_count, fn, *args)
+    job.add_done_callback(lambda _: self._release(document_count))
+    return await asyncio.wrap_future(job)
+
+  # Run an admitted generator job in the pool and yield its items as soon as they are
+  # produced. At most STREAM_BUFFER_SIZE items wait for the consumer; if the consumer
+  # goes away, the generator is closed at its next item.
+  # Input: document_count (int, as admitted), fn (generator function), args (positional arguments of fn)
+  # Output: async generator of the items of fn
+  async def stream(self, document_count, fn, *args):
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue(maxsize=STREAM_BUFFER_SIZE)
+    cancelled = threading.Event()
+    end = object()
+
+    def put(item):
+      future = asyncio.run_coroutine_threadsafe(items.put(item), loop)
+      while not cancelled.is_set():
+        try:
+          return future.result(timeout=1)
+        except FutureTimeoutError:
+          pass
+      future.cancel()
+
+    def produce():
+      generator = fn(*args)
+      try:
+        for item in generator:
+          if cancelled.is_set():
+            break
+          put(item)
+      finally:
+        generator.close()
+
+    def job():
+      try:
+        self._timed(document_count, produce)
+      except Exception as e:
+        put(e)
+      finally:
+        put(end)
+
+    future = loop.run_in_executor(self._executor, job)
+    try:
+      while True:
+        item = await items.get()
+        if item is end:
+          break
+        if isinstance(item, Exception):
+          raise item
+        yield item
+    finally:
+      cancelled.set()
+      future.add_done_callback(lambda _: self._release(document_count))
+
+  # Run a job, keeping a moving average of the processing time per document
+  # Input: document_count (int), fn (callable), args (positional arguments of fn)
+  # Output: the result of fn
+  def _timed(self, document_count, fn, *args):
+    start = time.perf_counter()
+    try:
+      return fn(*args)
+    finally:
+      seconds = (time.perf_counter() - start) / document_count
+      with self._lock:
+        # Moving average, so the estimate follows the current documents
+        if self.seconds_per_document is None:
+          self.seconds_per_document = seconds
+        else:
+          self.seconds_per_document = 0.8 * self.seconds_per_document + 0.2 * seconds
+
+  def _release(self, document_count):
+    with self._lock:
+      self.pending_documents -= document_count
+      self.completed += 1
+
+  # Estimate when the queue will have room again (called with the lock held)
+  # Output: int (seconds)
+  def retry_after(self):
+    if self.seconds_per_document is None:
+      return 30
+    return max(1, math.ceil(self.seconds_per_document * self.pending_documents / self.workers))
+
+  def shutdown(self):
+    logging.info('🛑 Stopping the document workers')
+    self._executor.shutdown(wait=False, cancel_futures=True)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'workers': self.workers,
+        'max_documents': self.max_documents,
+        'pending_documents': self.pending_documents,
+        'admitted': self.admitted,
+        'rejected': self.rejected,
+        'completed': self.completed,
+        'seconds_per_document': round(self.seconds_per_document, 3) if self.seconds_per_document else None,
+      }
@@ -0,0 +1,82 @@
+import logging
+import os
+import signal
+import time
+
+from pypdf import PdfReader
+
+
+class PageTextTimeout(Exception):
+  pass
+
+
+def _raise_page_timeout(signum, frame):
+  raise PageTextTimeout()
+
+
+# Document the worker process last read: (identity, open file, PdfReader)
+_document = None
+
+
+# Reader of a document file, parsed once per worker process and reused by the
+# following windows of the same document. Pages are read from the file on demand.
+# The file is identified by its inode and modification time besides its path, so a
+# new document written under the name of a deleted one is not read from the old reader.
+# Input: pdf_path (str)
+# Output: PdfReader
+def _document_reader(pdf_path):
+  global _document
+  file_stat = os.stat(pdf_path)
+  identity = (pdf_path, file_stat.st_ino, file_stat.st_mtime_ns)
+  if _document is None or _document[0] != identity:
+    _close_document()
+    pdf_file = open(pdf_path, 'rb')
+    try:
+      _document = (identity, pdf_file, PdfReader(pdf_file))
+    except BaseException:
+      pdf_file.close()
+      raise
+  return _document[2]
+
+
+# Close the document file kept by _document_reader, so its disk space is freed once deleted
+def _close_document():
+  global _document
+  if _document is not None:
+    _document[1].close()
+    _document = None
+
+
+# Extract the text of some pages of a PDF file (runs in a worker process).
+# Each page gets its own time budget, enforced with SIGALRM since pool workers run
+# tasks on their main thread: a pathological page yields an empty text instead of
+# stalling the rest of the document.
+# Input: pdf_path (str), page_indexes (List[int]), page_timeout (float, seconds),
+#        last_window (bool, the pages end the document: its file is closed afterwards)
+# Output: tuple (List[str] one text per requested page, float seconds spent)
+def extract_page_texts(pdf_path, page_indexes, page_timeout, last_window=False):
+  start = time.perf_counter()
+  reader = _document_reader(pdf_path)
+  previous_handler = signal.signal(signal.SIGALRM, _raise_page_timeout)
+  page_texts = []
+  try:
+    for page_index in page_indexes:
+      try:
+        # The alarm may still fire while it is being disarmed, hence the outer handler
+        signal.setitimer(signal.ITIMER_REAL, page_timeout)
+        try:
+          text = reader.pages[page_index].extract_text()
+        finally:
+          signal.setitimer(signal.ITIMER_REAL, 0)
+      except PageTextTimeout:
+        logging.warning(f'⚠️ Text extraction of page {page_index + 1} timed out after {page_timeout}s')
+        text = ''
+      except Exception as e:
+        logging.warning(f'⚠️ Text extraction of page {page_index + 1} failed: {e}')
+        text = ''
+      page_texts.append(text)
+  finally:
+    signal.signal(signal.SIGALRM, previous_handler)
+    if last_window:
+      _close_document()
+  return page_texts, time.perf_counter() - start